@@ -0,0 +1,105 @@
+import json
+import time
+import uuid
+
+# Constant parts of V3 responses. These are shared between responses, so
+# anything built from them must be copied before it is modified.
+RESPONSE_HEADER = {
+    "namespace": "Alexa",
+    "name": "Response",
+    "payloadVersion": "3"
+}
+
+CONNECTIVITY_OK = {
+    "value": "OK"
+}
+
+EMPTY_PAYLOAD = {}
+
+
+def get_uuid():
+    return str(uuid.uuid4())
+
+
+def get_utc_timestamp(seconds=None):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.00Z", time.gmtime(seconds))
+
+
+def get_property(namespace, name, value, time_of_sample, uncertainty=500):
+    return {
+        "namespace": namespace,
+        "name": name,
+        "value": value,
+        "timeOfSample": time_of_sample,
+        "uncertaintyInMilliseconds": uncertainty
+    }
+
+
+def get_connectivity_property(time_of_sample):
+    return get_property("Alexa.EndpointHealth", "connectivity", CONNECTIVITY_OK, time_of_sample, 200)
+
+
+def build_response(request, properties, name="Response"):
+    """
+    Builds a V3 response to request carrying the given context properties.
+
+    :param request: The directive being answered
+    :param properties: List of (namespace, name, value) tuples. All of them,
+        and the connectivity property that is always added, share one
+        timeOfSample.
+    :param name: Event name, ie 'Response' or 'StateReport'
+    """
+    time_of_sample = get_utc_timestamp()
+    header = request["directive"]["header"]
+
+    context_properties = [get_property(namespace, property_name, value, time_of_sample)
+                          for namespace, property_name, value in properties]
+    context_properties.append(get_connectivity_property(time_of_sample))
+
+    event_header = dict(RESPONSE_HEADER, name=name, messageId=get_uuid())
+    if "correlationToken" in header:
+        event_header["correlationToken"] = header["correlationToken"]
+
+    return {
+        "context": {
+            "properties": context_properties
+        },
+        "event": {
+            "header": event_header,
+            "endpoint": {
+                "endpointId": request["directive"]["endpoint"]["endpointId"]
+            },
+            "payload": EMPTY_PAYLOAD
+        }
+    }
+
+
+def build_error_response(request, error_type, message, details=None):
+    """
+    :param details: Extra payload fields the error type calls for, ie
+        validRange for TEMPERATURE_VALUE_OUT_OF_RANGE
+    """
+    header = request["directive"]["header"]
+
+    payload = {"type": error_type, "message": message}
+    if details:
+        payload.update(details)
+
+    event_header = dict(RESPONSE_HEADER, name="ErrorResponse", messageId=get_uuid())
+    if "correlationToken" in header:
+        event_header["correlationToken"] = header["correlationToken"]
+
+    return {
+        "event": {
+            "header": event_header,
+            "endpoint": {
+                "endpointId": request["directive"].get("endpoint", {}).get("endpointId", "")
+            },
+            "payload": payload
+        }
+    }
+
+
+def dumps(response):
+    # Compact output and no circular reference check, responses are plain trees
+    return json.dumps(response, separators=(',', ':'), check_circular=False)
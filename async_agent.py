@@ -0,0 +1,104 @@
+import asyncio
+
+# This is a dependency not native to the basic RPI install
+# It can be found here: https://pypi.python.org/pypi/aiohttp
+import aiohttp
+
+
+class AsyncAgent:
+    """
+    Runs device shadow deltas on an asyncio event loop instead of the MQTT
+    client's callback thread. Server updates go out through one shared
+    aiohttp session, so a slow request for one device no longer holds up
+    the deltas of every other device. Deltas for the same device are still
+    handled one at a time, in order.
+    """
+
+    def __init__(self, server_url, server_function, server_header,
+                 pool_size=8, timeout=5.0, rate_limiter=None, on_failed=None):
+        """
+        :param server_url: Base URL of the home server
+        :param server_function: dict of request key -> URL path
+        :param server_header: Headers sent with every request
+        :param pool_size: Most connections open to the server at once
+        :param timeout: Seconds before a server request is abandoned
+        :param rate_limiter: Optional command_queue.TokenBucket that server
+            requests are paced by
+        :param on_failed: Called with (request, device name) when a server
+            request couldn't be sent
+        """
+        self.server_url = server_url
+        self.server_function = server_function
+        self.server_header = server_header
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.on_failed = on_failed
+        self.loop = None
+        self.session = None
+        self._stopped = None
+        self._device_locks = {}
+
+    def submit(self, device, payload):
+        """
+        Hands a shadow delta over to the event loop. Safe to call from any
+        thread, normally the MQTT callback thread.
+        """
+        asyncio.run_coroutine_threadsafe(self.handle_delta(device, payload), self.loop)
+
+    async def handle_delta(self, device, payload):
+        lock = self._device_locks.setdefault(device.name, asyncio.Lock())
+
+        async with lock:
+            try:
+                # Publishing the reported state blocks on MQTT, keep it off the loop
+                requests_to_send = await self.loop.run_in_executor(None, device.apply_delta, payload)
+
+            except Exception as error:
+                print(str(device.friendlyName) + " delta failed: " + str(error))
+                return
+
+            for request in requests_to_send:
+                if self.rate_limiter is not None:
+                    await asyncio.sleep(self.rate_limiter.reserve())
+
+                try:
+                    await self.post(request)
+                except Exception as error:
+                    print("Server " + request.function + " request failed: " + str(error))
+
+                    if self.on_failed is not None:
+                        self.on_failed(request, device.name)
+
+    async def post(self, request):
+        """
+        :raises aiohttp.ClientError: The request failed or the server answered
+            with an error status
+        """
+        url = self.server_url + self.server_function[request.function]
+
+        async with self.session.post(url, data=request._asdict(), headers=self.server_header) as response:
+            await response.read()
+            response.raise_for_status()
+            return response.status
+
+    async def run(self, setup):
+        """
+        Runs the agent until stop() is called
+
+        :param setup: Called with no arguments, in a worker thread, once the
+            loop is running. Use it to connect and create the devices.
+        """
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+
+        connector = aiohttp.TCPConnector(limit=self.pool_size)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.session = session
+            await self.loop.run_in_executor(None, setup)
+            await self._stopped.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self._stopped.set)
@@ -0,0 +1,232 @@
+#!/usr/bin/env/python
+
+"""
+Load generator for lambdaFuncV3. Streams directives from a JSONL corpus
+(one {"directive": ...} request per line, or a traffic_log recording) into
+lambda_handler against the local_stack shadow service, and prints one JSON
+document with the throughput and p50/p95/p99 latency per directive,
+so results can be compared between commits.
+
+    python bench_lambda.py --corpus directives.jsonl --concurrency 8
+    python bench_lambda.py --count 5000 --pool process --concurrency 4
+
+Without a corpus a mix of the directives the skill receives is generated.
+"""
+
+import argparse
+import collections
+import json
+import math
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from device_registry import get_registry
+from local_stack import FakeShadowService, get_directive
+from traffic_log import read_requests
+
+# Set up in every worker by init_worker
+lambda_module = None
+
+
+def init_worker(shadow_latency, jitter):
+    """
+    Points lambdaFuncV3 at a local shadow service holding a reported state
+    for every device
+    """
+    global lambda_module
+
+    import lambdaFuncV3
+
+    shadows = FakeShadowService()
+    for device in get_registry().devices:
+        if device.category == "THERMOSTAT":
+            reported = {"value": 20, "scale": "CELSIUS", "mode": "AUTO", "temperature": 19}
+        else:
+            reported = {"light": False}
+        shadows.update_thing_shadow(thingName=device.appliance_id,
+                                    payload=json.dumps({"state": {"reported": reported}}))
+
+    # Seeded, now slow it down
+    shadows.latency = shadow_latency
+    shadows.jitter = jitter
+    lambdaFuncV3.client.set(shadows)
+    lambda_module = lambdaFuncV3
+
+
+def run_directive(request):
+    """
+    Calls lambda_handler once
+
+    :return: (namespace, name, seconds, error) where error is the error type
+        of an ErrorResponse or exception, else None
+    """
+    header = request["directive"]["header"]
+    started = time.perf_counter()
+
+    try:
+        response = lambda_module.lambda_handler(request, None)
+        error = None
+        if response["event"]["header"]["name"] == "ErrorResponse":
+            error = response["event"]["payload"]["type"]
+    except Exception as exception:
+        error = type(exception).__name__
+
+    return header["namespace"], header["name"], time.perf_counter() - started, error
+
+
+def run_batch(requests_to_run):
+    # Process pool tasks carry several directives to keep pickling off the clock
+    return [run_directive(request) for request in requests_to_run]
+
+
+def generate_corpus(count, seed=None):
+    """
+    Yields count directives in roughly the mix the skill sees: mostly
+    ReportState and power changes, some thermostat changes and the odd
+    Discover.
+    """
+    rng = random.Random(seed)
+    registry = get_registry()
+    lights = [device.appliance_id for device in registry.in_category("LIGHT")]
+    thermostats = [device.appliance_id for device in registry.in_category("THERMOSTAT")]
+    everything = lights + thermostats
+
+    for _ in range(count):
+        roll = rng.random()
+
+        if roll < 0.40:
+            yield get_directive("Alexa", "ReportState", rng.choice(everything))
+        elif roll < 0.75:
+            yield get_directive("Alexa.PowerController", rng.choice(("TurnOn", "TurnOff")), rng.choice(lights))
+        elif roll < 0.85:
+            yield get_directive("Alexa.ThermostatController", "SetTargetTemperature", rng.choice(thermostats),
+                                {"targetSetpoint": {"value": rng.randint(16, 26), "scale": "CELSIUS"}})
+        elif roll < 0.93:
+            yield get_directive("Alexa.ThermostatController", "AdjustTargetTemperature", rng.choice(thermostats),
+                                {"targetSetpointDelta": {"value": rng.choice((-1, 1)), "scale": "CELSIUS"}})
+        elif roll < 0.98:
+            yield get_directive("Alexa.ThermostatController", "SetThermostatMode", rng.choice(thermostats),
+                                {"thermostatMode": {"value": rng.choice(("HEAT", "COOL", "AUTO"))}})
+        else:
+            request = get_directive("Alexa.Discovery", "Discover", None)
+            del request["directive"]["endpoint"]
+            yield request
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_benchmark(corpus, concurrency=1, pool="thread", batch_size=50, shadow_latency=0.0, jitter=0.0):
+    """
+    Sends every directive in corpus through lambda_handler, keeping at most a
+    few batches per worker in flight so the corpus is never held in memory.
+
+    :return: dict of results, see summarize()
+    """
+    if pool == "process":
+        executor = ProcessPoolExecutor(max_workers=concurrency, initializer=init_worker,
+                                       initargs=(shadow_latency, jitter))
+    else:
+        init_worker(shadow_latency, jitter)
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    timings = collections.defaultdict(list)
+    errors = collections.Counter()
+    in_flight = collections.deque()
+
+    def collect(future):
+        for namespace, name, seconds, error in future.result():
+            timings[(namespace, name)].append(seconds)
+            if error is not None:
+                errors[(namespace, name, error)] += 1
+
+    started = time.perf_counter()
+
+    with executor:
+        for batch in chunks(corpus, batch_size):
+            if len(in_flight) >= concurrency * 4:
+                collect(in_flight.popleft())
+            in_flight.append(executor.submit(run_batch, batch))
+
+        while in_flight:
+            collect(in_flight.popleft())
+
+    elapsed = time.perf_counter() - started
+    return summarize(timings, errors, elapsed, concurrency, pool)
+
+
+def percentile(sorted_values, fraction):
+    # Nearest rank
+    rank = int(math.ceil(fraction * len(sorted_values)))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def get_latency_summary(values):
+    values = sorted(values)
+    return {"count": len(values),
+            "mean_ms": sum(values) / len(values) * 1000.0,
+            "p50_ms": percentile(values, 0.50) * 1000.0,
+            "p95_ms": percentile(values, 0.95) * 1000.0,
+            "p99_ms": percentile(values, 0.99) * 1000.0,
+            "max_ms": values[-1] * 1000.0}
+
+
+def summarize(timings, errors, elapsed, concurrency, pool):
+    total = sum(len(values) for values in timings.values())
+    every_timing = [seconds for values in timings.values() for seconds in values]
+
+    directives = {}
+    for (namespace, name), values in sorted(timings.items()):
+        summary = get_latency_summary(values)
+        summary["errors"] = dict((error, count) for (error_namespace, error_name, error), count in errors.items()
+                                 if (error_namespace, error_name) == (namespace, name))
+        directives[namespace + "." + name] = summary
+
+    return {"pool": pool,
+            "concurrency": concurrency,
+            "directives_total": total,
+            "errors_total": sum(errors.values()),
+            "elapsed_s": elapsed,
+            "throughput_per_s": total / elapsed if elapsed > 0 else 0.0,
+            "overall": get_latency_summary(every_timing) if every_timing else {},
+            "directives": directives}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for lambdaFuncV3")
+    parser.add_argument("--corpus", help="JSONL file of directives (default: a generated mix)")
+    parser.add_argument("--count", type=int, default=2000, help="Directives to generate without a corpus")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated mix")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--pool", choices=("thread", "process"), default="thread")
+    parser.add_argument("--batch-size", type=int, default=50, help="Directives per worker task")
+    parser.add_argument("--shadow-latency", type=float, default=0.0,
+                        help="Seconds added to every shadow call")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--output", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    corpus = read_requests(args.corpus) if args.corpus else generate_corpus(args.count, args.seed)
+
+    results = run_benchmark(corpus, args.concurrency, args.pool, args.batch_size,
+                            args.shadow_latency, args.jitter)
+    results["corpus"] = args.corpus or "generated"
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+
+    sys.exit(1 if results["directives_total"] == 0 else 0)
@@ -0,0 +1,94 @@
+#!/usr/bin/env/python
+
+"""
+Measures the cold start cost of the lambda handlers. Each run happens in a
+fresh interpreter, timing the module import and the first lambda_handler
+call, and prints one JSON line per run so results can be compared between
+commits.
+
+    python coldstart_profile.py --runs 5
+    python coldstart_profile.py --module lambdaFuncV3 --directive turn_on.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Sample directives that need no shadow access, used when none is given
+DEFAULT_DIRECTIVES = {
+    "lambdaFuncV2": {
+        "header": {
+            "namespace": "Alexa.ConnectedHome.Discovery",
+            "name": "DiscoverAppliancesRequest",
+            "payloadVersion": "2",
+            "messageId": "coldstart"
+        },
+        "payload": {
+            "accessToken": "coldstart"
+        }
+    },
+    "lambdaFuncV3": {
+        "directive": {
+            "header": {
+                "namespace": "Alexa.Discovery",
+                "name": "Discover",
+                "payloadVersion": "3",
+                "messageId": "coldstart"
+            },
+            "payload": {
+                "scope": {
+                    "type": "BearerToken",
+                    "token": "coldstart"
+                }
+            }
+        }
+    }
+}
+
+# Runs in the child interpreter
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+imported = time.perf_counter()
+module.lambda_handler(json.loads(sys.argv[2]), None)
+invoked = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000.0,
+                  "first_invoke_ms": (invoked - imported) * 1000.0}))
+"""
+
+
+def profile(module, directive):
+    """
+    Imports module in a new interpreter and calls its handler once.
+
+    :return: dict with import_ms and first_invoke_ms
+    """
+    output = subprocess.check_output(
+        [sys.executable, "-c", PROBE, module, json.dumps(directive)],
+        cwd=os.path.dirname(os.path.realpath(__file__)))
+
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold start profiler for the lambda handlers")
+    parser.add_argument("--module", action="append", choices=sorted(DEFAULT_DIRECTIVES),
+                        help="Handler module to profile, may be repeated (default: all)")
+    parser.add_argument("--directive", help="JSON file holding the directive for the first call")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    for module in args.module or sorted(DEFAULT_DIRECTIVES):
+        if args.directive:
+            with open(args.directive) as directive_file:
+                directive = json.load(directive_file)
+        else:
+            directive = DEFAULT_DIRECTIVES[module]
+
+        for run in range(args.runs):
+            result = profile(module, directive)
+            result.update({"module": module, "run": run})
+            print(json.dumps(result, sort_keys=True))
@@ -0,0 +1,217 @@
+import queue
+import threading
+import time
+
+from server_client import AllLightsRequest
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing rate operations per second on average, with bursts
+    of up to burst operations.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self._tokens = float(burst)
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token without blocking
+
+        :return: Seconds the caller has to wait before using it
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+
+            if self._tokens >= 0:
+                return 0.0
+
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until it can be used
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CommandQueue:
+    """
+    Outbound queue for home server requests. Sender threads drain it no
+    faster than the rate limiter allows. Commands with the same key (ie the
+    device name) always go to the same sender, so each device's commands are
+    sent in the order they were queued.
+    """
+
+    def __init__(self, server, rate=5.0, burst=5, senders=2, on_failed=None):
+        """
+        :param server: HomeServerClient, or anything with post(request)
+        :param rate: Requests per second the server can take
+        :param burst: Requests that may go out back to back after a quiet spell
+        :param senders: Number of sender threads
+        :param on_failed: Called with (request, key) on a sender thread when
+            a request couldn't be sent
+        """
+        self.server = server
+        self.limiter = TokenBucket(rate, burst)
+        self.on_failed = on_failed
+        self.sent = 0
+        self.failed = 0
+        self._count_lock = threading.Lock()
+        self._queues = [queue.Queue() for _ in range(senders)]
+
+        for command_queue in self._queues:
+            sender = threading.Thread(target=self._send_loop, args=(command_queue,))
+            sender.daemon = True
+            sender.start()
+
+    def put(self, request, key=None):
+        """
+        Queues a request for the server
+
+        :param request: One of the server_client *Request types
+        :param key: Ordering key, commands with the same key are sent in order
+        """
+        self._queues[hash(key) % len(self._queues)].put((request, key))
+
+    @property
+    def depth(self):
+        """
+        Number of commands waiting to be sent
+        """
+        return sum(command_queue.qsize() for command_queue in self._queues)
+
+    def join(self):
+        """
+        Blocks until every queued command has been sent
+        """
+        for command_queue in self._queues:
+            command_queue.join()
+
+    def stop(self):
+        for command_queue in self._queues:
+            command_queue.put(None)
+
+    def _send_loop(self, command_queue):
+        while True:
+            command = command_queue.get()
+
+            try:
+                if command is None:
+                    return
+
+                request, key = command
+                self.limiter.acquire()
+                self.server.post(request)
+
+                with self._count_lock:
+                    self.sent += 1
+
+            except Exception as error:
+                with self._count_lock:
+                    self.failed += 1
+                print("Server " + request.function + " request failed: " + str(error))
+
+                if self.on_failed is not None:
+                    self.on_failed(request, key)
+
+            finally:
+                command_queue.task_done()
+
+
+class LightCoalescer:
+    """
+    Sits in front of a CommandQueue and holds individual light commands for
+    a short window. If every light ends up with the same state within the
+    window (ie an "all lights off" scene) they are replaced with a single
+    allLights command. Other commands pass straight through.
+
+    The server has no per-floor endpoint, so a scene covering only some of
+    the lights is still sent light by light.
+    """
+
+    # Individual and bulk light commands share one ordering key so a later
+    # single light command can't overtake an earlier allLights one
+    KEY = "lights"
+
+    def __init__(self, commands, light_names, window=0.0, known_state=None):
+        """
+        :param commands: CommandQueue the commands end up on
+        :param light_names: Server names of every light in the house
+        :param window: Seconds light commands are held for, 0 disables
+        :param known_state: Called with a light's server name, returns the
+            state the server last got for it ('on'/'off') or None if unknown.
+            A state whose request failed must be reported as unknown.
+        """
+        self.commands = commands
+        self.light_names = frozenset(light_names)
+        self.known_state = known_state
+        self.window = window
+        self.collapsed = 0
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def put(self, request, key=None):
+        if request.function in ("light", "allLights"):
+            key = self.KEY
+
+        if request.function != "light" or self.window <= 0:
+            self.commands.put(request, key)
+            return
+
+        with self._lock:
+            # A newer command for the same light replaces the held one
+            self._pending[request.light] = request
+
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Sends whatever is being held
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._timer = None
+
+        if not pending:
+            return
+
+        states = set(request.state for request in pending.values())
+        state = states.pop() if len(states) == 1 else None
+
+        if state is not None and len(pending) > 1 and self.covers_all(state, pending):
+            self.commands.put(AllLightsRequest(state), self.KEY)
+
+            with self._lock:
+                self.collapsed += len(pending)
+            return
+
+        for request in pending.values():
+            self.commands.put(request, self.KEY)
+
+    def covers_all(self, state, pending):
+        """
+        :return: True if every light is either pending with state or
+            already known to be in it
+        """
+        for light in self.light_names:
+            if light in pending:
+                continue
+            if self.known_state is None or self.known_state(light) != state:
+                return False
+        return True
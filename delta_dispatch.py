@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DeltaStats:
+    """
+    Timing totals for the deltas handled for one thing
+    """
+    __slots__ = ('handled', 'failed', 'collapsed', 'wait_total', 'wait_max', 'handle_total', 'handle_max')
+
+    def __init__(self):
+        self.handled = 0
+        self.failed = 0
+        self.collapsed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.handle_total = 0.0
+        self.handle_max = 0.0
+
+    def record(self, wait, handle, failed):
+        self.handled += 1
+        self.failed += int(failed)
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.handle_total += handle
+        self.handle_max = max(self.handle_max, handle)
+
+    def as_dict(self):
+        handled = max(self.handled, 1)
+        return {"handled": self.handled,
+                "failed": self.failed,
+                "collapsed": self.collapsed,
+                "wait_avg_ms": self.wait_total / handled * 1000.0,
+                "wait_max_ms": self.wait_max * 1000.0,
+                "handle_avg_ms": self.handle_total / handled * 1000.0,
+                "handle_max_ms": self.handle_max * 1000.0}
+
+
+class DeltaDispatcher:
+    """
+    Moves shadow delta handling off the MQTT callback thread onto a bounded
+    thread pool. Deltas for the same thing are handled one at a time in the
+    order they arrived, while different things run in parallel.
+
+    Each thing has a single pending slot. A delta arriving while an older one
+    is still waiting is merged into it, newer keys winning, so only the
+    latest requested state gets actuated and reported.
+    """
+
+    def __init__(self, max_workers=4, clock=time.monotonic):
+        self.clock = clock
+        self.stats = {}
+        self.collapsed = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def submit(self, device, payload):
+        """
+        Queues a delta for device.handle_delta(payload). Called from the MQTT
+        callback thread.
+        """
+        with self._lock:
+            waiting = self._pending.get(device.name)
+
+            if waiting is None:
+                self._pending[device.name] = (self.clock(), payload)
+            else:
+                # Keep the older delta's queue time so the wait stats stay honest
+                queued_at, waiting_payload = waiting
+                self._pending[device.name] = (queued_at, merge_deltas(waiting_payload, payload))
+                self.collapsed += 1
+                self._get_stats(device.name).collapsed += 1
+
+            # A worker is already going through this thing's deltas
+            if device.name in self._running:
+                return
+
+            self._running.add(device.name)
+
+        self._executor.submit(self._run_next, device)
+
+    def _run_next(self, device):
+        with self._lock:
+            queued_at, payload = self._pending.pop(device.name)
+
+        started = self.clock()
+        failed = False
+
+        try:
+            device.handle_delta(payload)
+        except Exception as error:
+            failed = True
+            print(str(device.friendlyName) + " delta failed: " + str(error))
+
+        finished = self.clock()
+
+        with self._lock:
+            self._get_stats(device.name).record(started - queued_at, finished - started, failed)
+
+            if device.name not in self._pending:
+                self._running.discard(device.name)
+                return
+
+        # Go to the back of the pool's queue rather than hogging a worker
+        self._executor.submit(self._run_next, device)
+
+    @property
+    def depth(self):
+        """
+        Number of deltas waiting to be handled
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def _get_stats(self, thing_name):
+        stats = self.stats.get(thing_name)
+        if stats is None:
+            stats = self.stats[thing_name] = DeltaStats()
+        return stats
+
+    def report(self):
+        """
+        :return: dict of thing name -> timing summary
+        """
+        with self._lock:
+            return {thing_name: stats.as_dict() for thing_name, stats in self.stats.items()}
+
+
+def merge_deltas(older, newer):
+    """
+    Combines two shadow delta payloads into one, the newer values winning
+    """
+    state = json.loads(older).get("state", {})
+    state.update(json.loads(newer).get("state", {}))
+    return json.dumps({"state": state})
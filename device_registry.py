@@ -0,0 +1,124 @@
+import json
+import os
+from collections import namedtuple
+
+# devices.json lives next to this file unless DEVICE_REGISTRY says otherwise
+DEFAULT_REGISTRY_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'devices.json')
+
+Device = namedtuple('Device', ['appliance_id', 'friendly_name', 'description', 'category', 'server_name'])
+
+# V2 appliance fields that only depend on the device category
+V2_APPLIANCE_TEMPLATES = {
+    'THERMOSTAT': {
+        'actions': [
+            'turnOn',
+            'turnOff',
+            'setTargetTemperature',
+            'incrementTargetTemperature',
+            'decrementTargetTemperature'
+        ],
+        'modelName': 'Smart Thermostat'
+    },
+    'LIGHT': {
+        'actions': [
+            'turnOn',
+            'turnOff'
+        ],
+        'modelName': 'Smart Light'
+    }
+}
+
+
+class DeviceRegistry:
+    """
+    The devices in the house, indexed by applianceId (the AWS IoT thing
+    name), by the home server's switch name and by category.
+    """
+
+    def __init__(self, devices):
+        """
+        :param devices: Iterable of Device
+        """
+        self.devices = list(devices)
+        self.by_id = {}
+        self.by_server_name = {}
+        self.by_category = {}
+        self._v2_appliances = None
+
+        for device in self.devices:
+            if device.appliance_id in self.by_id:
+                raise ValueError("Duplicate applianceId " + device.appliance_id)
+
+            self.by_id[device.appliance_id] = device
+            self.by_category.setdefault(device.category, []).append(device)
+
+            if device.server_name:
+                self.by_server_name[device.server_name] = device
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Reads a registry file, a JSON list of objects with applianceId,
+        friendlyName, friendlyDescription, category and serverName keys.
+        """
+        path = path or os.environ.get('DEVICE_REGISTRY', DEFAULT_REGISTRY_PATH)
+
+        with open(path) as registry_file:
+            entries = json.load(registry_file)
+
+        return cls(Device(entry['applianceId'],
+                          entry['friendlyName'],
+                          entry.get('friendlyDescription', ''),
+                          entry['category'],
+                          entry.get('serverName'))
+                   for entry in entries)
+
+    def get(self, appliance_id):
+        return self.by_id.get(appliance_id)
+
+    def get_by_server_name(self, server_name):
+        return self.by_server_name.get(server_name)
+
+    def in_category(self, category):
+        return self.by_category.get(category, [])
+
+    def v2_appliances(self):
+        """
+        Returns the devices as V2 discovery appliances. Built once and shared,
+        so the caller must not modify the result.
+        """
+        if self._v2_appliances is None:
+            self._v2_appliances = [get_v2_appliance(device) for device in self.devices]
+
+        return self._v2_appliances
+
+
+def get_v2_appliance(device):
+    template = V2_APPLIANCE_TEMPLATES.get(device.category, V2_APPLIANCE_TEMPLATES['LIGHT'])
+
+    return {
+        'applianceId': device.appliance_id,
+        'friendlyName': device.friendly_name,
+        'friendlyDescription': device.description,
+        'actions': template['actions'],
+        'additionalApplianceDetails': {},
+        'isReachable': True,
+        'manufacturerName': 'SmartHome',
+        'modelName': template['modelName'],
+        'version': '1'
+    }
+
+
+_default_registry = None
+
+
+def get_registry():
+    """
+    Returns the registry loaded from the default path, loading it on first use
+    """
+    global _default_registry
+
+    if _default_registry is None:
+        _default_registry = DeviceRegistry.load()
+
+    return _default_registry
@@ -0,0 +1,57 @@
+import threading
+
+
+class StateTable:
+    """
+    The last state each device acknowledged, kept per channel (ie 'shadow'
+    for reported shadow updates, 'server' for home server requests). Used to
+    skip publishes and server calls that wouldn't change anything.
+    """
+
+    def __init__(self, enabled=True):
+        """
+        :param enabled: When False every update is treated as a change
+        """
+        self.enabled = enabled
+        self.suppressed = 0
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def changes(self, thing_name, channel, values):
+        """
+        Records values as the thing's state on channel
+
+        :param values: dict of key -> new value
+        :return: dict of the keys whose value differs from the last known one
+        """
+        with self._lock:
+            known = self._states.setdefault((thing_name, channel), {})
+
+            if self.enabled:
+                changed = dict((key, value) for key, value in values.items()
+                               if key not in known or known[key] != value)
+            else:
+                changed = dict(values)
+
+            if values and not changed:
+                self.suppressed += 1
+
+            known.update(values)
+            return changed
+
+    def get(self, thing_name, channel):
+        """
+        :return: Copy of the last known values of the thing on channel
+        """
+        with self._lock:
+            return dict(self._states.get((thing_name, channel), {}))
+
+    def forget(self, thing_name=None, channel=None):
+        """
+        Drops the known state so the next update is sent regardless. With no
+        arguments every device is forced to resync.
+        """
+        with self._lock:
+            for key in list(self._states):
+                if thing_name in (None, key[0]) and channel in (None, key[1]):
+                    del self._states[key]
@@ -0,0 +1,37 @@
+class DirectiveDispatcher:
+    """
+    Routes directives to handler functions by their (namespace, name) pair.
+    Used by both the V2 and V3 lambda handlers.
+    """
+
+    def __init__(self, fallback):
+        """
+        :param fallback: Called as fallback(namespace, name, *args) when no
+            handler is registered for a directive
+        """
+        self.handlers = {}
+        self.fallback = fallback
+
+    def register(self, namespace, name):
+        """
+        Decorator that registers a handler for a directive
+
+        :param namespace: Directive header namespace, ie 'Alexa.PowerController'
+        :param name: Directive header name, ie 'TurnOn'
+        """
+        def decorator(handler):
+            self.handlers[(namespace, name)] = handler
+            return handler
+        return decorator
+
+    def dispatch(self, namespace, name, *args):
+        """
+        Calls the handler registered for (namespace, name) with *args and
+        returns its result.
+        """
+        handler = self.handlers.get((namespace, name))
+
+        if handler is None:
+            return self.fallback(namespace, name, *args)
+
+        return handler(*args)
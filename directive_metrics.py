@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+
+# DIRECTIVE_METRICS=1 turns the timings on. Off, every timer call is a no-op.
+ENABLED = os.environ.get('DIRECTIVE_METRICS', '0').lower() in ('1', 'true', 'yes')
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AlexaSmartHome')
+
+
+class PhaseTimer:
+    """
+    Splits the time spent on one directive into phases. Each lap() charges the
+    time since the previous lap to the named phase, so phases that come round
+    more than once (ie shadow_read) add up.
+    """
+    __slots__ = ('clock', 'started', 'last', 'phases', 'counts')
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = self.last = clock()
+        self.phases = {}
+        self.counts = {}
+
+    def lap(self, phase):
+        now = self.clock()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def emit(self, directive):
+        """
+        Prints the timings as one CloudWatch embedded metric format line,
+        with the directive as its dimension
+
+        :param directive: 'namespace.name' of the directive
+        """
+        print(get_metric_line(directive, self.last - self.started, self.phases, self.counts))
+
+
+class NullTimer:
+    """
+    Stands in for PhaseTimer while metrics are off
+    """
+    __slots__ = ()
+
+    def lap(self, phase):
+        pass
+
+    def count(self, name, amount=1):
+        pass
+
+    def emit(self, directive):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+_local = threading.local()
+
+
+def start():
+    """
+    Starts timing a directive on this thread
+
+    :return: The timer, a NullTimer when metrics are off
+    """
+    timer = PhaseTimer() if ENABLED else NULL_TIMER
+    _local.timer = timer
+    return timer
+
+
+def current():
+    """
+    :return: The timer of the directive being handled on this thread
+    """
+    return getattr(_local, 'timer', NULL_TIMER)
+
+
+def get_metric_line(directive, total, phases, counts):
+    values = {name + "_ms": seconds * 1000.0 for name, seconds in phases.items()}
+    values["total_ms"] = total * 1000.0
+
+    metrics = [{"Name": name, "Unit": "Milliseconds"} for name in sorted(values)]
+    metrics.extend({"Name": name, "Unit": "Count"} for name in sorted(counts))
+    values.update(counts)
+
+    values["Directive"] = directive
+    values["_aws"] = {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [{
+            "Namespace": NAMESPACE,
+            "Dimensions": [["Directive"]],
+            "Metrics": metrics
+        }]
+    }
+
+    return json.dumps(values, separators=(',', ':'))
@@ -0,0 +1,50 @@
+import os
+import threading
+
+
+class IotDataClient:
+    """
+    Holds a boto3 'iot-data' client that is only created the first time it is
+    used, keeping boto3's import and setup out of the container's cold start
+    for directives that never touch a shadow (ie Discover). Attribute access
+    is forwarded to the real client, so this can be used anywhere the client
+    itself is expected.
+
+    IOT_DATA_ENDPOINT and IOT_DATA_MAX_POOL set the defaults for endpoint_url
+    and max_pool_connections.
+    """
+
+    def __init__(self, endpoint_url=None, max_pool_connections=None):
+        """
+        :param endpoint_url: Overrides the AWS endpoint, ie to point at a local stub
+        :param max_pool_connections: Size of the client's HTTPS connection pool
+        """
+        self.endpoint_url = endpoint_url or os.environ.get('IOT_DATA_ENDPOINT')
+        self.max_pool_connections = max_pool_connections or int(os.environ.get('IOT_DATA_MAX_POOL', '10'))
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create()
+
+        return self._client
+
+    def set(self, client):
+        """
+        Replaces the underlying client, ie with a fake for testing
+        """
+        self._client = client
+
+    def _create(self):
+        import boto3
+        from botocore.config import Config
+
+        return boto3.client('iot-data',
+                            endpoint_url=self.endpoint_url,
+                            config=Config(max_pool_connections=self.max_pool_connections))
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
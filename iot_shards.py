@@ -0,0 +1,135 @@
+import threading
+import time
+import zlib
+
+
+def get_shard_key(thing_name):
+    """
+    Things on the same floor share a shard, ie F1_HallLight -> F1. Names
+    without a floor prefix are their own key.
+    """
+    return thing_name.split('_', 1)[0]
+
+
+class ShardStats:
+    __slots__ = ('online', 'things', 'deltas', 'updates', 'started')
+
+    def __init__(self):
+        # Stays False until the connection's onOnline callback fires
+        self.online = False
+        self.things = 0
+        self.deltas = 0
+        self.updates = 0
+        self.started = time.monotonic()
+
+    def on_online(self):
+        self.online = True
+
+    def on_offline(self):
+        self.online = False
+
+    def as_dict(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {"online": self.online,
+                "things": self.things,
+                "deltas": self.deltas,
+                "updates": self.updates,
+                "deltas_per_s": self.deltas / elapsed,
+                "updates_per_s": self.updates / elapsed}
+
+
+class ShardedShadowClient:
+    """
+    Spreads shadow handlers over several MQTT connections so one websocket
+    and its callback thread don't carry the whole house. Used in place of a
+    single AWSIoTMQTTShadowClient, ie passed to create_devices().
+    """
+
+    def __init__(self, clients, stats, shard_key=get_shard_key, thing_names=()):
+        """
+        :param clients: Connected AWSIoTMQTTShadowClient objects, one per shard
+        :param stats: ShardStats per client, whose on_online/on_offline were
+            given to the client before it connected, see create_iot()
+        :param shard_key: Maps a thing name to the key it is sharded by
+        :param thing_names: Every thing that will get a handler, used to
+            spread them evenly over the shards
+        """
+        self.clients = list(clients)
+        self.stats = list(stats)
+        self.shard_key = shard_key
+        self.assignments = get_assignments(thing_names, len(self.clients), shard_key)
+        self._lock = threading.Lock()
+
+        used = set(self.assignments.values())
+        for index in range(len(self.clients)):
+            if thing_names and index not in used:
+                print("Warning: shard " + str(index) + " has no devices, its connection is idle")
+
+    def shard_for(self, thing_name):
+        index = self.assignments.get(thing_name)
+        if index is None:
+            # Not known up front. crc32 rather than hash() so it is stable across restarts
+            index = zlib.crc32(thing_name.encode()) % len(self.clients)
+        return index
+
+    def createShadowHandlerWithName(self, thing_name, isPersistentSubscribe):
+        index = self.shard_for(thing_name)
+        handler = self.clients[index].createShadowHandlerWithName(thing_name, isPersistentSubscribe)
+
+        with self._lock:
+            self.stats[index].things += 1
+
+        return CountingShadowHandler(handler, self.stats[index], self._lock)
+
+    def report(self):
+        """
+        :return: List of per shard health and message counts
+        """
+        with self._lock:
+            return [stats.as_dict() for stats in self.stats]
+
+
+def get_assignments(thing_names, shards, shard_key=get_shard_key):
+    """
+    Spreads things over shards. The distinct shard keys are dealt out in
+    sorted order so each shard gets its share of floors. With more shards
+    than keys the things themselves are dealt out instead, as keeping a floor
+    together would leave shards idle.
+
+    :return: dict of thing name -> shard index
+    """
+    thing_names = sorted(set(thing_names))
+    keys = sorted(set(shard_key(thing_name) for thing_name in thing_names))
+
+    if len(keys) >= shards:
+        key_shards = dict((key, index % shards) for index, key in enumerate(keys))
+        return dict((thing_name, key_shards[shard_key(thing_name)]) for thing_name in thing_names)
+
+    return dict((thing_name, index % shards) for index, thing_name in enumerate(thing_names))
+
+
+class CountingShadowHandler:
+    """
+    Wraps a shadow handler to count the deltas and updates going through it
+    """
+
+    def __init__(self, handler, stats, lock):
+        self.handler = handler
+        self.stats = stats
+        self.lock = lock
+
+    def shadowRegisterDeltaCallback(self, callback):
+        def counting_callback(payload, responseStatus, token):
+            with self.lock:
+                self.stats.deltas += 1
+            callback(payload, responseStatus, token)
+
+        return self.handler.shadowRegisterDeltaCallback(counting_callback)
+
+    def shadowUpdate(self, payload, callback, timeout):
+        with self.lock:
+            self.stats.updates += 1
+        return self.handler.shadowUpdate(payload, callback, timeout)
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
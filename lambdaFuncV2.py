@@ -1,11 +1,15 @@
 import logging
-import boto3
 import json
 
+from device_registry import get_registry
+from directive_dispatch import DirectiveDispatcher
+from iot_client import IotDataClient
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-client = boto3.client('iot-data')
+# Created on first use, see iot_client
+client = IotDataClient()
 
 
 def lambda_handler(event, context):
@@ -29,163 +33,44 @@ def handleDiscovery(context, event):
             'payloadVersion': '2'
         },
         'payload': {
-            'discoveredAppliances': [
-                {
-                    'applianceId': 'Thermostat',
-                    'friendlyName': 'Thermostat',
-                    'friendlyDescription': 'The thermostat controlled by AlexaPi',
-                    'actions': [
-                        'turnOn',
-                        'turnOff',
-                        'setTargetTemperature',
-                        'incrementTargetTemperature',
-                        'decrementTargetTemperature'
-                    ],
-                    'additionalApplianceDetails': {},
-                    'isReachable': True,
-                    'manufacturerName': 'SmartHome',
-                    'modelName': '1',
-                    'version': '1'
-                },
-
-                {
-                    'applianceId': 'F1_DiningLight',
-                    'friendlyName': 'Dining Room Light',
-                    'friendlyDescription': 'The dining room light controlled by AlexaPi',
-                    'actions': [
-                        'turnOn',
-                        'turnOff'
-                    ],
-                    'additionalApplianceDetails': {},
-                    'isReachable': True,
-                    'manufacturerName': 'SmartHome',
-                    'modelName': '1',
-                    'version': '1'
-                },
-
-                {
-                    'applianceId': 'F1_KitchenLight',
-                    'friendlyName': 'Kitchen Light',
-                    'friendlyDescription': 'The kitchen light controlled by AlexaPi',
-                    'actions': [
-                        'turnOn',
-                        'turnOff'
-                    ],
-                    'additionalApplianceDetails': {},
-                    'isReachable': True,
-                    'manufacturerName': 'SmartHome',
-                    'modelName': '1',
-                    'version': '1'
-                },
-
-                {
-                    'applianceId': 'F1_HallLight',
-                    'friendlyName': 'Hall Light',
-                    'friendlyDescription': 'The hall light controlled by AlexaPi',
-                    'actions': [
-                        'turnOn',
-                        'turnOff'
-                    ],
-                    'additionalApplianceDetails': {},
-                    'isReachable': True,
-                    'manufacturerName': 'SmartHome',
-                    'modelName': '1',
-                    'version': '1'
-                },
-
-                {
-                    'applianceId': 'F1_PatioLight',
-                    'friendlyName': 'Patio Light',
-                    'friendlyDescription': 'The patio light controlled by AlexaPi',
-                    'actions': [
-                        'turnOn',
-                        'turnOff'
-                    ],
-                    'additionalApplianceDetails': {},
-                    'isReachable': True,
-                    'manufacturerName': 'SmartHome',
-                    'modelName': '1',
-                    'version': '1'
-                },
-
-                {
-                    'applianceId': 'F2_RestRoomLight',
-                    'friendlyName': 'Bathroom Light',
-                    'friendlyDescription': 'The bathroom light controlled by AlexaPi',
-                    'actions': [
-                        'turnOn',
-                        'turnOff'
-                    ],
-                    'additionalApplianceDetails': {},
-                    'isReachable': True,
-                    'manufacturerName': 'SmartHome',
-                    'modelName': '1',
-                    'version': '1'
-                },
-
-                {
-                    'applianceId': 'F2_BedRoomLight',
-                    'friendlyName': 'Bedroom Light',
-                    'friendlyDescription': 'The bedroom light controlled by AlexaPi',
-                    'actions': [
-                        'turnOn',
-                        'turnOff'
-                    ],
-                    'additionalApplianceDetails': {},
-                    'isReachable': True,
-                    'manufacturerName': 'SmartHome',
-                    'modelName': '1',
-                    'version': '1'
-                },
-
-                {
-                    'applianceId': 'F2_LivingRoomLight',
-                    'friendlyName': 'Living Room Light',
-                    'friendlyDescription': 'The living room light controlled by AlexaPi',
-                    'actions': [
-                        'turnOn',
-                        'turnOff'
-                    ],
-                    'additionalApplianceDetails': {},
-                    'isReachable': True,
-                    'manufacturerName': 'SmartHome',
-                    'modelName': '1',
-                    'version': '1'
-                },
-
-                {
-                    'applianceId': 'F3_AtticLight',
-                    'friendlyName': 'Attic Light',
-                    'friendlyDescription': 'The attic light controlled by AlexaPi',
-                    'actions': [
-                        'turnOn',
-                        'turnOff'
-                    ],
-                    'additionalApplianceDetails': {},
-                    'isReachable': True,
-                    'manufacturerName': 'SmartHome',
-                    'modelName': '1',
-                    'version': '1'
-                }
-            ]
+            'discoveredAppliances': get_registry().v2_appliances()
         }
     }
 
 
 def handleControl(context, event):
-    device_id = event['payload']['appliance']['applianceId']
-    requestType = event['header']['name']
+    return v2_dispatcher.dispatch(event['header']['namespace'], event['header']['name'], context, event)
 
-    if requestType == 'TurnOnRequest':
-        name = 'TurnOnConfirmation'
-        light = True
 
-    elif requestType == 'TurnOffRequest':
-        name = 'TurnOffConfirmation'
-        light = False
+def handleUnsupportedControl(namespace, name, context, event):
+    logger.error('no handler for %s %s' % (namespace, name))
 
-    # elif requestType == 'SetTargetTemperatureRequest':
-    # name = ''
+    return {
+        'header': {
+            "messageId": event['header']['messageId'],
+            "name": "UnsupportedOperationError",
+            "namespace": "Alexa.ConnectedHome.Control",
+            "payloadVersion": "2"
+        },
+        'payload': {}
+    }
+
+
+v2_dispatcher = DirectiveDispatcher(handleUnsupportedControl)
+
+
+@v2_dispatcher.register('Alexa.ConnectedHome.Control', 'TurnOnRequest')
+def handleTurnOn(context, event):
+    return setLight(event, True, 'TurnOnConfirmation')
+
+
+@v2_dispatcher.register('Alexa.ConnectedHome.Control', 'TurnOffRequest')
+def handleTurnOff(context, event):
+    return setLight(event, False, 'TurnOffConfirmation')
+
+
+def setLight(event, light, name):
+    device_id = event['payload']['appliance']['applianceId']
 
     logger.info('turning %s %s' % ('on' if light else 'off', device_id))
 
@@ -210,4 +95,4 @@ def handleControl(context, event):
             "payloadVersion": "2"
         },
         'payload': {}
-    }
\ No newline at end of file
+    }
@@ -1,164 +1,88 @@
 import logging
-import boto3
-import json
-import time
-import uuid
+import os
+import random
+
+import directive_metrics
+import temperature
+import alexa_response
+from alexa_response import dumps, get_uuid
+from device_registry import get_registry
+from directive_dispatch import DirectiveDispatcher
+from iot_client import IotDataClient
+from shadow_cache import ShadowStateCache
+from shadow_writer import ShadowWriter
+from traffic_log import TrafficRecorder
 
 # Setup logger
+# Directives and responses are only logged at DEBUG. LOG_SAMPLE_RATE (0.0 - 1.0)
+# limits that to a fraction of the invocations.
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-client = boto3.client('iot-data')
-
-SMART_HOME_APPLIANCES = [
-    {
-        'applianceId': 'Thermostat',
-        'friendlyName': 'Thermostat',
-        'friendlyDescription': 'The thermostat controlled by AlexaPi',
-        'actions': [
-            'turnOn',
-            'turnOff',
-            'setTargetTemperature',
-            'incrementTargetTemperature',
-            'decrementTargetTemperature'
-        ],
-        'additionalApplianceDetails': {},
-        'isReachable': True,
-        'manufacturerName': 'SmartHome',
-        'modelName': 'Smart Thermostat',
-        'version': '1'
-    },
-    {
-        'applianceId': 'F1_DiningLight',
-        'friendlyName': 'Dining Room Light',
-        'friendlyDescription': 'The dining room light controlled by AlexaPi',
-        'actions': [
-            'turnOn',
-            'turnOff'
-        ],
-        'additionalApplianceDetails': {},
-        'isReachable': True,
-        'manufacturerName': 'SmartHome',
-        'modelName': 'Smart Light',
-        'version': '1'
-    },
-    {
-        'applianceId': 'F1_KitchenLight',
-        'friendlyName': 'Kitchen Light',
-        'friendlyDescription': 'The kitchen light controlled by AlexaPi',
-        'actions': [
-            'turnOn',
-            'turnOff'
-        ],
-        'additionalApplianceDetails': {},
-        'isReachable': True,
-        'manufacturerName': 'SmartHome',
-        'modelName': 'Smart Light',
-        'version': '1'
-    },
-    {
-        'applianceId': 'F1_HallLight',
-        'friendlyName': 'Hall Light',
-        'friendlyDescription': 'The hall light controlled by AlexaPi',
-        'actions': [
-            'turnOn',
-            'turnOff'
-        ],
-        'additionalApplianceDetails': {},
-        'isReachable': True,
-        'manufacturerName': 'SmartHome',
-        'modelName': 'Smart Light',
-        'version': '1'
-    },
-    {
-        'applianceId': 'F1_PatioLight',
-        'friendlyName': 'Patio Light',
-        'friendlyDescription': 'The patio light controlled by AlexaPi',
-        'actions': [
-            'turnOn',
-            'turnOff'
-        ],
-        'additionalApplianceDetails': {},
-        'isReachable': True,
-        'manufacturerName': 'SmartHome',
-        'modelName': 'Smart Light',
-        'version': '1'
-    },
-    {
-        'applianceId': 'F2_RestRoomLight',
-        'friendlyName': 'Bathroom Light',
-        'friendlyDescription': 'The bathroom light controlled by AlexaPi',
-        'actions': [
-            'turnOn',
-            'turnOff'
-        ],
-        'additionalApplianceDetails': {},
-        'isReachable': True,
-        'manufacturerName': 'SmartHome',
-        'modelName': 'Smart Light',
-        'version': '1'
-    },
-    {
-        'applianceId': 'F2_BedRoomLight',
-        'friendlyName': 'Bedroom Light',
-        'friendlyDescription': 'The bedroom light controlled by AlexaPi',
-        'actions': [
-            'turnOn',
-            'turnOff'
-        ],
-        'additionalApplianceDetails': {},
-        'isReachable': True,
-        'manufacturerName': 'SmartHome',
-        'modelName': 'Smart Light',
-        'version': '1'
-    },
-    {
-        'applianceId': 'F2_LivingRoomLight',
-        'friendlyName': 'Living Room Light',
-        'friendlyDescription': 'The living room light controlled by AlexaPi',
-        'actions': [
-            'turnOn',
-            'turnOff'
-        ],
-        'additionalApplianceDetails': {},
-        'isReachable': True,
-        'manufacturerName': 'SmartHome',
-        'modelName': 'Smart Light',
-        'version': '1'
-    },
-    {
-        'applianceId': 'F3_AtticLight',
-        'friendlyName': 'Attic Light',
-        'friendlyDescription': 'The attic light controlled by AlexaPi',
-        'actions': [
-            'turnOn',
-            'turnOff'
-        ],
-        'additionalApplianceDetails': {},
-        'isReachable': True,
-        'manufacturerName': 'SmartHome',
-        'modelName': 'Smart Light',
-        'version': '1'
-    }
-]
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+
+# Created on first use, see iot_client
+client = IotDataClient()
+shadow_writer = ShadowWriter(client)
+shadow_cache = ShadowStateCache(client, ttl=float(os.environ.get('SHADOW_CACHE_TTL', '30')))
+
+# RECORD_PATH turns on recording of every directive and its response, with
+# tokens redacted, for replay with traffic_log.read_requests
+recorder = None
+if os.environ.get('RECORD_PATH'):
+    recorder = TrafficRecorder(os.environ['RECORD_PATH'],
+                               max_bytes=int(os.environ.get('RECORD_MAX_BYTES', str(64 * 1024 * 1024))))
+
+# Scale the thermostat, and so the home server, works in. Setpoints are
+# converted to it before they reach the shadow.
+THERMOSTAT_SCALE = os.environ.get('THERMOSTAT_SCALE', temperature.CELSIUS)
+
+# ReportState answers from shadows no older than this many seconds
+REPORT_STATE_MAX_AGE = float(os.environ.get('REPORT_STATE_MAX_AGE', '5'))
 
 
 def lambda_handler(request, context):
+    # Per phase timings, see directive_metrics. A no-op unless DIRECTIVE_METRICS is set.
+    timer = directive_metrics.start()
+
     try:
-        logger.info("Directive:")
-        logger.info(json.dumps(request, indent=4, sort_keys=True))
+        log_payloads = should_log_payloads()
+        if log_payloads:
+            log_payload("Directive:", request)
+            timer.lap("log")
 
         version = get_directive_version(request)
 
         if version == "3":
             logger.info("Received V3 Directive!")
-            if request["directive"]["header"]["name"] == "Discover":
+            header = request["directive"]["header"]
+            timer.lap("parse")
+
+            if header["name"] == "Discover":
                 response = handle_discovery_v3(request)
+                timer.lap("handle")
             else:
                 response = handle_non_discovery_v3(request)
+                timer.lap("handle")
+
+                results = flush_shadow_writes_v3()
+                timer.lap("shadow_write")
+                timer.count("shadow_writes", len(results))
 
-        logger.info("Response:")
-        logger.info(json.dumps(response, indent=4, sort_keys=True))
+                response = check_shadow_writes_v3(request, response, results)
+
+            if response["event"]["header"]["name"] == "ErrorResponse":
+                timer.count("errors")
+
+        if log_payloads:
+            log_payload("Response:", response)
+            timer.lap("log")
+
+        if recorder is not None:
+            recorder.record(request, response)
+            recorder.flush()
+
+        if version == "3":
+            timer.emit(header["namespace"] + "." + header["name"])
 
         return response
 
@@ -167,12 +91,108 @@ def lambda_handler(request, context):
         raise
 
 
+def batch_handler(event, context):
+    """
+    Handles many V3 directives in one invocation, ie every endpoint a scene
+    touches. The shadow writes of the whole batch are sent together, in
+    parallel, and a directive that fails only fails its own response.
+
+    Directives for the same endpoint have their shadow writes merged, the
+    later directive's values winning. A relative directive (ie
+    AdjustTargetTemperature) starts from the writes queued before it, so
+    two +1 adjustments add up to +2.
+
+    :param event: List of V3 directives, or {"directives": [...]}
+    :return: List of responses, in the order of the directives
+    """
+    if isinstance(event, dict):
+        event = event.get("directives", [])
+
+    timer = directive_metrics.start()
+    logger.info("Received batch of %d directives", len(event))
+
+    responses = [handle_batch_directive_v3(request) for request in event]
+    timer.lap("handle")
+
+    results = flush_shadow_writes_v3()
+    timer.lap("shadow_write")
+    timer.count("shadow_writes", len(results))
+
+    for index, request in enumerate(event):
+        if is_valid_directive_v3(request):
+            responses[index] = check_shadow_writes_v3(request, responses[index], results)
+
+        if responses[index]["event"]["header"]["name"] == "ErrorResponse":
+            timer.count("errors")
+
+        if recorder is not None:
+            recorder.record(request, responses[index])
+
+    # Lambda can freeze and reap the container without a clean exit, so
+    # nothing may be left in the buffer between invocations
+    if recorder is not None:
+        recorder.flush()
+
+    timer.count("directives", len(event))
+    timer.emit("Batch")
+
+    return responses
+
+
+def handle_batch_directive_v3(request):
+    if not is_valid_directive_v3(request):
+        logger.error("Invalid directive in batch: %s", dumps(request))
+        return build_error_response_v3(INVALID_REQUEST, "INVALID_DIRECTIVE", "Not a V3 directive")
+
+    try:
+        if request["directive"]["header"]["name"] == "Discover":
+            return handle_discovery_v3(request)
+
+        return handle_non_discovery_v3(request)
+
+    except Exception as error:
+        logger.exception("Directive failed")
+        return build_error_response_v3(request, "INTERNAL_ERROR", str(error))
+
+
+def is_valid_directive_v3(request):
+    try:
+        header = request["directive"]["header"]
+        if header["payloadVersion"] != "3" or not header["namespace"] or not header["name"]:
+            return False
+
+        return header["name"] == "Discover" or bool(request["directive"]["endpoint"]["endpointId"])
+
+    except (KeyError, TypeError):
+        return False
+
+
+# Stands in for a directive too malformed to answer properly
+INVALID_REQUEST = {"directive": {"header": {}}}
+
+
 # V3 Handlers
-def handle_discovery_v3(request):
-    endpoints = []
-    for appliance in SMART_HOME_APPLIANCES:
-        endpoints.append(get_endpoint_from_v2_appliance(appliance))
+def build_response_v3(request, properties, name="Response"):
+    # Times the response building apart from the handler, see directive_metrics
+    timer = directive_metrics.current()
+    timer.lap("handle")
+    response = alexa_response.build_response(request, properties, name)
+    timer.lap("build")
+    return response
+
+
+def build_error_response_v3(request, error_type, message, details=None):
+    timer = directive_metrics.current()
+    timer.lap("handle")
+    response = alexa_response.build_error_response(request, error_type, message, details)
+    timer.lap("build")
+    return response
+
 
+def handle_discovery_v3(request):
+    # The endpoint list never changes for the life of the container, so it is
+    # built on the first Discover and shared by every response after that.
+    # Only the header (and its messageId) is created per request.
     response = {
         "event": {
             "header": {
@@ -182,7 +202,7 @@ def handle_discovery_v3(request):
                 "messageId": get_uuid()
             },
             "payload": {
-                "endpoints": endpoints
+                "endpoints": get_discovery_endpoints()
             }
         }
     }
@@ -194,244 +214,245 @@ def handle_non_discovery_v3(request):
     request_namespace = request["directive"]["header"]["namespace"]
     request_name = request["directive"]["header"]["name"]
 
-    if request_namespace == "Alexa.PowerController":
-        if request_name == "TurnOn":
-            value = "ON"
-            light_state = True
+    return v3_dispatcher.dispatch(request_namespace, request_name, request)
+
+
+def flush_shadow_writes_v3():
+    """
+    Sends the queued shadow updates and records the successful ones in the
+    shadow cache.
+    """
+    results = shadow_writer.flush()
+
+    for thing_name, result in results.items():
+        if result.error is None:
+            shadow_cache.update_desired(thing_name, result.desired)
         else:
-            value = "OFF"
-            light_state = False
-
-        # Update the thing shadow
-        client.update_thing_shadow(
-            thingName=request["directive"]["endpoint"]["endpointId"],
-            payload=json.dumps({'state': {'desired': {'light': light_state}}}))
-
-        response = {
-            "context": {
-                "properties": [
-                    {
-                        "namespace": "Alexa.PowerController",
-                        "name": "powerState",
-                        "value": value,
-                        "timeOfSample": get_utc_timestamp(),
-                        "uncertaintyInMilliseconds": 500
-                    },
-                    {
-                        "namespace": "Alexa.EndpointHealth",
-                        "name": "connectivity",
-                        "value": {
-                            "value": "OK"
-                        },
-                        "timeOfSample": get_utc_timestamp(),
-                        "uncertaintyInMilliseconds": 200
-                    }
-                ]
-            },
-            "event": {
-                "header": {
-                    "namespace": "Alexa",
-                    "name": "Response",
-                    "payloadVersion": "3",
-                    "messageId": get_uuid(),
-                    "correlationToken": request["directive"]["header"]["correlationToken"]
-                },
-                "endpoint": {
-                    "scope": {
-                        "type": "BearerToken",
-                        "token": "access-token-from-Amazon"
-                    },
-                    "endpointId": request["directive"]["endpoint"]["endpointId"]
-                },
-                "payload": {}
-            }
-        }
+            shadow_cache.invalidate(thing_name)
+
+    return results
+
+
+def check_shadow_writes_v3(request, response, results):
+    """
+    Swaps the response for an ErrorResponse if the shadow write for the
+    directive's endpoint failed.
+    """
+    endpoint_id = request["directive"].get("endpoint", {}).get("endpointId")
+    result = results.get(endpoint_id)
+
+    if result is None or result.error is None:
         return response
 
-    elif request_namespace == "Alexa.ThermostatController":
-
-        if request_name == "SetTargetTemperature":
-            # Using this accessing nomenclature will become problematic if dual
-            # mode is used to set the thermostat. Check documenation API
-            target_temp = request["directive"]["payload"]["targetSetpoint"]["value"]
-            target_scale = request["directive"]["payload"]["targetSetpoint"]["scale"]
-
-            # Update the thing shadow
-            client.update_thing_shadow(
-                thingName=request["directive"]["endpoint"]["endpointId"],
-                payload=json.dumps({
-                    'state': {
-                        'desired': {
-                            'value': target_temp,
-                            'scale': target_scale
-                        }
-                    }
-                })
-            )
-
-            response = {
-                "context": {
-                    "properties": [
-                        {
-                            "namespace": "Alexa.ThermostatController",
-                            "name": "targetSetpoint",
-                            "value": {
-                                "value": target_temp,
-                                "scale": target_scale
-                            },
-                            "timeOfSample": get_utc_timestamp(),
-                            "uncertaintyInMilliseconds": 500
-                        },
-                        {
-                            "namespace": "Alexa.EndpointHealth",
-                            "name": "connectivity",
-                            "value": {
-                                "value": "OK"
-                            },
-                            "timeOfSample": get_utc_timestamp(),
-                            "uncertaintyInMilliseconds": 200
-                        }
-                    ]
-                },
-                "event": {
-                    "header": {
-                        "namespace": "Alexa",
-                        "name": "Response",
-                        "payloadVersion": "3",
-                        "messageId": request["directive"]["header"]["messageId"],
-                        "correlationToken": request["directive"]["header"]["correlationToken"]
-                    },
-                    "endpoint": {
-                        "endpointId": request["directive"]["endpoint"]["endpointId"]
-                    },
-                    "payload": {}
-                }
-            }
-            return response
-
-        elif request_name == "AdjustTargetTemperature":
-            target_delta_temp = request["directive"]["payload"]["targetSetpointDelta"]["value"]
-            target_delta_scale = request["directive"]["payload"]["targetSetpointDelta"]["scale"]
-
-            stream_obj = client.get_thing_shadow(thingName=request["directive"]["endpoint"]["endpointId"])
-            current_thing_state = json.loads(stream_obj["payload"].read())
-
-            current_thing_temp = current_thing_state["state"]["desired"]["value"]
-            new_temp = current_thing_temp + target_delta_temp
-
-            # Update the thing shadow
-            client.update_thing_shadow(
-                thingName=request["directive"]["endpoint"]["endpointId"],
-                payload=json.dumps({
-                    'state': {
-                        'desired': {
-                            'value': new_temp,
-                            'scale': target_delta_scale
-                        }
-                    }
-                })
-            )
-
-            response = {
-                "context": {
-                    "properties": [
-                        {
-                            "namespace": "Alexa.ThermostatController",
-                            "name": "targetSetpoint",
-                            "value": {
-                                "value": new_temp,
-                                "scale": target_delta_scale
-                            },
-                            "timeOfSample": get_utc_timestamp(),
-                            "uncertaintyInMilliseconds": 500
-                        },
-                        {
-                            "namespace": "Alexa.EndpointHealth",
-                            "name": "connectivity",
-                            "value": {
-                                "value": "OK"
-                            },
-                            "timeOfSample": get_utc_timestamp(),
-                            "uncertaintyInMilliseconds": 200
-                        }
-                    ]
-                },
-                "event": {
-                    "header": {
-                        "namespace": "Alexa",
-                        "name": "Response",
-                        "payloadVersion": "3",
-                        "messageId": request["directive"]["header"]["messageId"],
-                        "correlationToken": request["directive"]["header"]["correlationToken"]
-                    },
-                    "endpoint": {
-                        "endpointId": request["directive"]["endpoint"]["endpointId"]
-                    },
-                    "payload": {}
-                }
-            }
-            return response
-
-        elif request_name == "SetThermostatMode":
-            target_mode = request["directive"]["payload"]["thermostatMode"]["value"]
-
-            # Update the thing shadow
-            client.update_thing_shadow(
-                thingName=request["directive"]["endpoint"]["endpointId"],
-                payload=json.dumps({
-                    'state': {
-                        'desired': {
-                            'mode': target_mode
-                        }
-                    }
-                })
-            )
-
-            response = {
-                "context": {
-                    "properties": [
-                        {
-                            "namespace": "Alexa.ThermostatController",
-                            "name": "thermostatMode",
-                            "value": target_mode,
-                            "timeOfSample": get_utc_timestamp(),
-                            "uncertaintyInMilliseconds": 500
-                        },
-                        {
-                            "namespace": "Alexa.EndpointHealth",
-                            "name": "connectivity",
-                            "value": {
-                                "value": "OK"
-                            },
-                            "timeOfSample": get_utc_timestamp(),
-                            "uncertaintyInMilliseconds": 200
-                        }
-                    ]
-                },
-                "event": {
-                    "header": {
-                        "namespace": "Alexa",
-                        "name": "Response",
-                        "payloadVersion": "3",
-                        "messageId": request["directive"]["header"]["messageId"],
-                        "correlationToken": request["directive"]["header"]["correlationToken"]
-                    },
-                    "endpoint": {
-                        "endpointId": request["directive"]["endpoint"]["endpointId"]
-                    },
-                    "payload": {}
-                }
+    logger.error("Shadow update for %s failed: %s", endpoint_id, result.error)
+    return build_error_response_v3(request, "ENDPOINT_UNREACHABLE", "Unable to update " + endpoint_id)
+
+
+def handle_unsupported_directive_v3(request_namespace, request_name, request):
+    logger.error("No handler for directive %s.%s", request_namespace, request_name)
+
+    return build_error_response_v3(request, "INVALID_DIRECTIVE",
+                                   "Unsupported directive " + request_namespace + "." + request_name)
+
+
+v3_dispatcher = DirectiveDispatcher(handle_unsupported_directive_v3)
+
+
+@v3_dispatcher.register("Alexa.PowerController", "TurnOn")
+@v3_dispatcher.register("Alexa.PowerController", "TurnOff")
+def handle_power_controller_v3(request):
+    light_state = request["directive"]["header"]["name"] == "TurnOn"
+
+    # Queue the thing shadow update, it is sent once the handler returns
+    shadow_writer.add(request["directive"]["endpoint"]["endpointId"], {'light': light_state})
+
+    return build_response_v3(request, [
+        ("Alexa.PowerController", "powerState", "ON" if light_state else "OFF")
+    ])
+
+
+@v3_dispatcher.register("Alexa.ThermostatController", "SetTargetTemperature")
+def handle_set_target_temperature_v3(request):
+    # Using this accessing nomenclature will become problematic if dual
+    # mode is used to set the thermostat. Check documenation API
+    target_temp = request["directive"]["payload"]["targetSetpoint"]["value"]
+    target_scale = request["directive"]["payload"]["targetSetpoint"]["scale"]
+
+    try:
+        new_temp = temperature.set_setpoint(target_temp, target_scale, THERMOSTAT_SCALE)
+    except temperature.SetpointOutOfRange as error:
+        return build_error_response_v3(request, "TEMPERATURE_VALUE_OUT_OF_RANGE", str(error), {
+            "validRange": {
+                "minimumValue": {"value": error.minimum, "scale": error.scale},
+                "maximumValue": {"value": error.maximum, "scale": error.scale}
             }
-            return response
+        })
+    except ValueError as error:
+        return build_error_response_v3(request, "INVALID_VALUE", str(error))
+
+    # Queue the thing shadow update, it is sent once the handler returns
+    shadow_writer.add(request["directive"]["endpoint"]["endpointId"], {
+        'value': new_temp,
+        'scale': THERMOSTAT_SCALE
+    })
+
+    # Answer in the scale that was asked for
+    return build_response_v3(request, [
+        ("Alexa.ThermostatController", "targetSetpoint",
+         {"value": round(temperature.convert(new_temp, THERMOSTAT_SCALE, target_scale), 1), "scale": target_scale})
+    ])
+
+
+@v3_dispatcher.register("Alexa.ThermostatController", "AdjustTargetTemperature")
+def handle_adjust_target_temperature_v3(request):
+    target_delta_temp = request["directive"]["payload"]["targetSetpointDelta"]["value"]
+    target_delta_scale = request["directive"]["payload"]["targetSetpointDelta"]["scale"]
+
+    endpoint_id = request["directive"]["endpoint"]["endpointId"]
+
+    timer = directive_metrics.current()
+    timer.lap("handle")
+
+    try:
+        current_thing_state = shadow_cache.get(endpoint_id)
+    except Exception as error:
+        logger.error("Unable to read shadow for %s: %s", endpoint_id, error)
+        return build_error_response_v3(request, "ENDPOINT_UNREACHABLE", "Unable to read " + endpoint_id)
+
+    timer.lap("shadow_read")
+    timer.count("shadow_lookups")
+
+    # A write queued earlier in the same batch hasn't reached the shadow yet,
+    # so it is applied over the cached desired state. Fall back on what the
+    # thermostat last reported if nothing was ever requested through Alexa.
+    current_setpoint = dict(current_thing_state.get("desired", {}), **shadow_writer.get_pending(endpoint_id))
+    if current_setpoint.get("value") is None:
+        current_setpoint = current_thing_state.get("reported", {})
+
+    if current_setpoint.get("value") is None:
+        return build_error_response_v3(request, "INTERNAL_ERROR", "No current setpoint for " + endpoint_id)
+
+    # The delta and the current setpoint can be in different scales
+    try:
+        new_temp = temperature.adjust_setpoint(current_setpoint["value"],
+                                               current_setpoint.get("scale", THERMOSTAT_SCALE),
+                                               target_delta_temp, target_delta_scale, THERMOSTAT_SCALE)
+        response_temp = round(temperature.convert(new_temp, THERMOSTAT_SCALE, target_delta_scale), 1)
+    except ValueError as error:
+        return build_error_response_v3(request, "INVALID_VALUE", str(error))
+
+    # Queue the thing shadow update, it is sent once the handler returns
+    shadow_writer.add(endpoint_id, {
+        'value': new_temp,
+        'scale': THERMOSTAT_SCALE
+    })
+
+    return build_response_v3(request, [
+        ("Alexa.ThermostatController", "targetSetpoint", {"value": response_temp, "scale": target_delta_scale})
+    ])
+
+
+@v3_dispatcher.register("Alexa.ThermostatController", "SetThermostatMode")
+def handle_set_thermostat_mode_v3(request):
+    target_mode = request["directive"]["payload"]["thermostatMode"]["value"]
+
+    # Queue the thing shadow update, it is sent once the handler returns
+    shadow_writer.add(request["directive"]["endpoint"]["endpointId"], {
+        'mode': target_mode
+    })
+
+    return build_response_v3(request, [
+        ("Alexa.ThermostatController", "thermostatMode", target_mode)
+    ])
+
+
+@v3_dispatcher.register("Alexa", "ReportState")
+def handle_report_state_v3(request):
+    endpoint_id = request["directive"]["endpoint"]["endpointId"]
+
+    timer = directive_metrics.current()
+    timer.lap("handle")
+
+    # The app refreshes every device tile at once, so a miss starts reading
+    # the other shadows in the background for the ReportStates that follow.
+    # Only this endpoint's own read is waited on. Reads still running when
+    # the container is frozen carry on once it thaws.
+    if not shadow_cache.is_fresh(endpoint_id, REPORT_STATE_MAX_AGE):
+        thing_names = [endpoint["endpointId"] for endpoint in get_discovery_endpoints()
+                       if endpoint["endpointId"] != endpoint_id]
+        timer.count("shadow_fetches", len(shadow_cache.prefetch(thing_names, REPORT_STATE_MAX_AGE)) + 1)
+
+    try:
+        current_thing_state = shadow_cache.get(endpoint_id, REPORT_STATE_MAX_AGE)
+    except Exception as error:
+        logger.error("Unable to read shadow for %s: %s", endpoint_id, error)
+        return build_error_response_v3(request, "ENDPOINT_UNREACHABLE", "Unable to read " + endpoint_id)
+
+    timer.lap("shadow_read")
+    timer.count("shadow_lookups")
+
+    return build_response_v3(request, get_properties_from_reported_state(current_thing_state.get("reported", {})),
+                             name="StateReport")
+
+
+# Logging
+def should_log_payloads():
+    """
+    Decides once per invocation whether the directive and response get logged,
+    so a sampled directive always has its response logged with it.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+
+    return LOG_SAMPLE_RATE >= 1.0 or random.random() < LOG_SAMPLE_RATE
+
+
+def log_payload(label, payload):
+    # Compact single line JSON so each payload is one CloudWatch event
+    logger.debug("%s %s", label, dumps(payload))
 
 
 # V3 Utility Functions
-def get_uuid():
-    return str(uuid.uuid4())
+_discovery_endpoints = None
+
+
+def get_discovery_endpoints():
+    """
+    Returns the V3 endpoint list for the devices in the registry, building it
+    once per container. The returned list is shared between responses and must
+    not be modified by the caller.
+    """
+    global _discovery_endpoints
+
+    if _discovery_endpoints is None:
+        _discovery_endpoints = [get_endpoint_from_v2_appliance(appliance)
+                                for appliance in get_registry().v2_appliances()]
+
+    return _discovery_endpoints
+
+
+def get_properties_from_reported_state(reported):
+    """
+    Translates the reported section of a thing shadow, as written by
+    smarthome.py, into (namespace, name, value) property tuples.
+    """
+    properties = []
+
+    if "light" in reported:
+        properties.append(("Alexa.PowerController", "powerState", "ON" if reported["light"] else "OFF"))
+
+    if "value" in reported:
+        properties.append(("Alexa.ThermostatController", "targetSetpoint",
+                           {"value": reported["value"], "scale": reported.get("scale", "CELSIUS")}))
+
+    if "mode" in reported:
+        properties.append(("Alexa.ThermostatController", "thermostatMode", reported["mode"]))
 
+    if "temperature" in reported:
+        properties.append(("Alexa.TemperatureSensor", "temperature",
+                           {"value": reported["temperature"], "scale": reported.get("scale", "CELSIUS")}))
 
-def get_utc_timestamp(seconds=None):
-    return time.strftime("%Y-%m-%dT%H:%M:%S.00Z", time.gmtime(seconds))
+    return properties
 
 
 def get_endpoint_from_v2_appliance(appliance):
@@ -0,0 +1,375 @@
+#!/usr/bin/env/python
+
+"""
+In-process stand-ins for AWS IoT thing shadows and the home server, so the
+lambda handlers, the smarthome.py agent and server_com_test.py can run end to
+end without AWS or the LAN server. Both take an injected latency.
+
+Running this file sends a few directives through lambdaFuncV3 and the agent
+and prints how long each took to reach the home server, or replays a
+traffic_log recording at its recorded pace:
+
+    python local_stack.py --shadow-latency 0.05 --server-latency 0.02
+    python local_stack.py --replay capture.jsonl --speed 10
+"""
+
+import argparse
+import io
+import json
+import queue
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+
+class ResourceNotFoundException(Exception):
+    """
+    Raised by get_thing_shadow for a thing without a shadow, like iot-data does
+    """
+
+
+def sleep_latency(latency, jitter):
+    if latency > 0 or jitter > 0:
+        time.sleep(latency + random.uniform(0, jitter))
+
+
+class FakeShadowService:
+    """
+    Thing shadows held in memory. It can be used as the boto3 'iot-data'
+    client (update_thing_shadow / get_thing_shadow) and as a connected
+    AWSIoTMQTTShadowClient (createShadowHandlerWithName), so the lambda and
+    the agent can talk to each other through it.
+
+    Like AWS IoT, an update that changes the desired state publishes a delta
+    of the desired keys that differ from the reported state. Deltas are
+    delivered on a single callback thread, as the MQTT client does.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        """
+        :param latency: Seconds added to every shadow operation
+        :param jitter: Up to this many extra random seconds per operation
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.shadows = {}
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._callbacks = queue.Queue()
+
+        callback_thread = threading.Thread(target=self._callback_loop)
+        callback_thread.daemon = True
+        callback_thread.start()
+
+    # iot-data client
+    def update_thing_shadow(self, thingName, payload):
+        sleep_latency(self.latency, self.jitter)
+        document = self._update(thingName, json.loads(payload).get('state', {}))
+        return {'payload': io.BytesIO(json.dumps(document).encode())}
+
+    def get_thing_shadow(self, thingName):
+        sleep_latency(self.latency, self.jitter)
+
+        with self._lock:
+            if thingName not in self.shadows:
+                raise ResourceNotFoundException("No shadow exists with name: '" + thingName + "'")
+            document = json.dumps(self.shadows[thingName])
+
+        return {'payload': io.BytesIO(document.encode())}
+
+    # AWSIoTMQTTShadowClient
+    def configureEndpoint(self, *args):
+        pass
+
+    def configureCredentials(self, *args):
+        pass
+
+    def configureConnectDisconnectTimeout(self, *args):
+        pass
+
+    def configureMQTTOperationTimeout(self, *args):
+        pass
+
+    def connect(self):
+        return True
+
+    def createShadowHandlerWithName(self, thing_name, isPersistentSubscribe):
+        handler = FakeShadowHandler(self, thing_name)
+
+        with self._lock:
+            self._handlers.setdefault(thing_name, []).append(handler)
+
+        return handler
+
+    def _update(self, thing_name, state):
+        with self._lock:
+            document = self.shadows.setdefault(thing_name, {'state': {}, 'version': 0})
+
+            for section in ('desired', 'reported'):
+                if section in state:
+                    document['state'].setdefault(section, {}).update(state[section])
+
+            document['version'] += 1
+            delta = get_delta(document['state'])
+
+            if 'desired' in state and delta:
+                message = json.dumps({'state': delta, 'version': document['version']})
+                for handler in self._handlers.get(thing_name, []):
+                    if handler.delta_callback is not None:
+                        self._callbacks.put((handler.delta_callback, (message, 'delta', None)))
+
+            return json.loads(json.dumps(document))
+
+    def _callback_loop(self):
+        while True:
+            callback, args = self._callbacks.get()
+            try:
+                callback(*args)
+            except Exception as error:
+                print("Shadow callback failed: " + str(error))
+
+
+class FakeShadowHandler:
+    """
+    The per-thing handler returned by FakeShadowService.createShadowHandlerWithName
+    """
+
+    def __init__(self, service, thing_name):
+        self.service = service
+        self.thing_name = thing_name
+        self.delta_callback = None
+
+    def shadowRegisterDeltaCallback(self, callback):
+        self.delta_callback = callback
+
+    def shadowUpdate(self, payload, callback, timeout):
+        sleep_latency(self.service.latency, self.service.jitter)
+        document = self.service._update(self.thing_name, json.loads(payload).get('state', {}))
+
+        if callback is not None:
+            self.service._callbacks.put((callback, (json.dumps(document), 'accepted', None)))
+
+    def shadowGet(self, callback, timeout):
+        def get():
+            try:
+                stream_obj = self.service.get_thing_shadow(thingName=self.thing_name)
+                callback(stream_obj['payload'].read().decode(), 'accepted', None)
+            except ResourceNotFoundException:
+                callback(json.dumps({'code': 404}), 'rejected', None)
+
+        getter = threading.Thread(target=get)
+        getter.daemon = True
+        getter.start()
+
+
+def get_delta(state):
+    desired = state.get('desired', {})
+    reported = state.get('reported', {})
+    return dict((key, value) for key, value in desired.items()
+                if key not in reported or reported[key] != value)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeHomeServer:
+    """
+    The home server's update endpoints on a local port. Every request is
+    logged with its arrival time and the resulting state is kept.
+    """
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0):
+        """
+        :param port: Port to listen on, 0 picks a free one
+        :param latency: Seconds added before every response
+        :param jitter: Up to this many extra random seconds per response
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.lights = {}
+        self.mode = None
+        self.set_temp = None
+        self.current_temp = None
+        self.requests = []
+        self.request_arrived = threading.Condition()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                form = dict((key, values[-1]) for key, values in
+                            parse_qs(self.rfile.read(length).decode()).items())
+
+                sleep_latency(fake.latency, fake.jitter)
+                status = fake.handle(self.path, form)
+
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.httpd.server_address[1])
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, path, form):
+        with self.request_arrived:
+            if path == '/updateLight':
+                self.lights[form.get('light')] = form.get('state')
+            elif path == '/updateAllLight':
+                for light in self.lights:
+                    self.lights[light] = form.get('state')
+            elif path == '/updateMode':
+                self.mode = form.get('mode')
+            elif path == '/updateSetTemp':
+                self.set_temp = form.get('setTemp')
+            elif path == '/updateCurrTemp':
+                self.current_temp = form.get('currTemp')
+            else:
+                return 404
+
+            self.requests.append((time.monotonic(), path, form))
+            self.request_arrived.notify_all()
+            return 200
+
+    def wait_for(self, count, timeout=10.0):
+        """
+        Blocks until at least count requests have arrived
+
+        :return: True if they did before the timeout
+        """
+        deadline = time.monotonic() + timeout
+
+        with self.request_arrived:
+            while len(self.requests) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.request_arrived.wait(remaining)
+
+        return True
+
+
+def get_directive(namespace, name, endpoint_id, payload=None):
+    return {
+        "directive": {
+            "header": {
+                "namespace": namespace,
+                "name": name,
+                "payloadVersion": "3",
+                "messageId": "local-" + str(random.getrandbits(32)),
+                "correlationToken": "local"
+            },
+            "endpoint": {
+                "scope": {
+                    "type": "BearerToken",
+                    "token": "local"
+                },
+                "endpointId": endpoint_id,
+                "cookie": {}
+            },
+            "payload": payload or {}
+        }
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the lambda and the agent against local fakes")
+    parser.add_argument("--shadow-latency", type=float, default=0.05)
+    parser.add_argument("--server-latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--replay", help="traffic_log recording to send instead of the sample directives")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than recorded")
+    args = parser.parse_args()
+
+    import lambdaFuncV3
+    import smarthome
+    from server_client import HomeServerClient
+
+    server = FakeHomeServer(latency=args.server_latency, jitter=args.jitter).start()
+    shadows = FakeShadowService(latency=args.shadow_latency, jitter=args.jitter)
+
+    # Point both ends at the fakes
+    lambdaFuncV3.client.set(shadows)
+    smarthome.command_queue.server = HomeServerClient(url=server.url)
+
+    devices = smarthome.create_devices(smarthome.get_registry(), shadows, smarthome.DeltaDispatcher())
+    smarthome.reconcile_devices(devices)
+
+    # Let the startup server requests go out before timing anything
+    smarthome.light_coalescer.flush()
+    smarthome.command_queue.join()
+
+    if args.replay:
+        from traffic_log import paced, read_records
+
+        replayed = 0
+        started = time.monotonic()
+
+        for record in paced(read_records(args.replay), args.speed):
+            request = record.get("request", record)
+            if "directive" in request:
+                lambdaFuncV3.lambda_handler(request, None)
+                replayed += 1
+
+        # Give the agent a moment to catch up with the last deltas
+        time.sleep(1.0)
+        smarthome.light_coalescer.flush()
+        smarthome.command_queue.join()
+
+        print(json.dumps({"replayed": replayed,
+                          "elapsed_s": time.monotonic() - started,
+                          "server_requests": len(server.requests),
+                          "server_sent": smarthome.command_queue.sent,
+                          "server_failed": smarthome.command_queue.failed},
+                         sort_keys=True))
+    else:
+        directives = [
+            get_directive("Alexa.PowerController", "TurnOn", "F1_HallLight"),
+            get_directive("Alexa.ThermostatController", "SetTargetTemperature", "Thermostat",
+                          {"targetSetpoint": {"value": 21, "scale": "CELSIUS"}}),
+            get_directive("Alexa.ThermostatController", "SetThermostatMode", "Thermostat",
+                          {"thermostatMode": {"value": "HEAT"}}),
+            get_directive("Alexa.PowerController", "TurnOff", "F1_HallLight"),
+        ]
+
+        for directive in directives:
+            header = directive["directive"]["header"]
+            expected = len(server.requests) + 1
+
+            started = time.monotonic()
+            response = lambdaFuncV3.lambda_handler(directive, None)
+            handled = time.monotonic()
+            arrived = server.wait_for(expected)
+
+            print(json.dumps({"directive": header["namespace"] + "." + header["name"],
+                              "response": response["event"]["header"]["name"],
+                              "lambda_ms": (handled - started) * 1000.0,
+                              "end_to_end_ms": (server.requests[-1][0] - started) * 1000.0 if arrived else None},
+                             sort_keys=True))
+
+    server.stop()
@@ -0,0 +1,108 @@
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+server_url = 'http://10.194.240.42:3000'
+server_header = {"items": "Content-Type:application/json"}
+server_function = {"light":        "/updateLight",
+                   "allLights":    "/updateAllLight",
+                   "mode":         "/updateMode",
+                   "setTemp":      "/updateSetTemp",
+                   "currentTemp":  "/updateCurrTemp"}
+
+
+# One immutable request type per server function. Each call builds its own
+# request, so concurrent device updates can't see each other's values.
+class LightRequest(namedtuple('LightRequest', ['light', 'state'])):
+    __slots__ = ()
+    function = "light"
+
+
+class AllLightsRequest(namedtuple('AllLightsRequest', ['light', 'state'])):
+    __slots__ = ()
+    function = "allLights"
+
+    def __new__(cls, state):
+        return super(AllLightsRequest, cls).__new__(cls, "lights", state)
+
+
+class ModeRequest(namedtuple('ModeRequest', ['room', 'mode'])):
+    __slots__ = ()
+    function = "mode"
+
+    def __new__(cls, mode, room="home"):
+        return super(ModeRequest, cls).__new__(cls, room, mode)
+
+
+class SetTempRequest(namedtuple('SetTempRequest', ['room', 'setTemp'])):
+    __slots__ = ()
+    function = "setTemp"
+
+    def __new__(cls, set_temp, room="home"):
+        return super(SetTempRequest, cls).__new__(cls, room, set_temp)
+
+
+class CurrentTempRequest(namedtuple('CurrentTempRequest', ['room', 'currTemp'])):
+    __slots__ = ()
+    function = "currentTemp"
+
+    def __new__(cls, current_temp, room="home"):
+        return super(CurrentTempRequest, cls).__new__(cls, room, current_temp)
+
+
+class HomeServerClient:
+    """
+    Talks to the home server over one keep-alive session, so device updates
+    reuse pooled connections instead of opening a new one per request.
+    Failed requests are retried with exponential backoff.
+    """
+
+    def __init__(self, url=server_url, functions=server_function, headers=server_header,
+                 pool_size=4, timeout=(3.05, 5.0), retries=3, backoff=0.3):
+        """
+        :param url: Base URL of the home server
+        :param functions: dict of request key -> URL path
+        :param headers: Headers sent with every request
+        :param pool_size: Most connections kept open to the server
+        :param timeout: (connect, read) timeout in seconds
+        :param retries: Attempts after the first one fails
+        :param backoff: Backoff factor, retry n waits backoff * 2^(n-1) seconds
+        """
+        self.url = url
+        self.functions = functions
+        self.timeout = timeout
+
+        # Every server endpoint sets absolute state, so a POST is safe to retry
+        try:
+            retry = Retry(total=retries, backoff_factor=backoff,
+                          status_forcelist=(500, 502, 503, 504), allowed_methods=None)
+        except TypeError:
+            # urllib3 < 1.26
+            retry = Retry(total=retries, backoff_factor=backoff,
+                          status_forcelist=(500, 502, 503, 504), method_whitelist=False)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, request):
+        """
+        Sends a request to the server
+
+        :param request: One of the *Request types, ie LightRequest
+        :return: requests.Response
+        :raises requests.RequestException: The request failed or the server
+            answered with an error status
+        """
+        response = self.session.post(self.url + self.functions[request.function], data=request._asdict(),
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def close(self):
+        self.session.close()
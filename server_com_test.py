@@ -1,62 +1,41 @@
-import os
-import json
-import time
-import requests
+import argparse
 
-server_url = 'http://10.194.240.42:3000'
-server_header = {"items": "Content-Type:application/json"}
-server_function = {"light":        "/updateLight",
-                   "allLights":    "/updateAllLight",
-                   "mode":         "/updateMode",
-                   "setTemp":      "/updateSetTemp",
-                   "currentTemp":  "/updateCurrTemp"}
-
-server_payload = {"light":         {"light": "<light_name>",    "state": ""},
-                  "allLights":     {"light": "lights",          "state": ""},
-                  "mode":          {"room": "home",             "mode": ""},
-                  "setTemp":       {"room": "home",             "setTemp": 0},
-                  "currentTemp":   {"room": "home",             "currTemp": 0}}
+from command_queue import CommandQueue
+from server_client import (AllLightsRequest, HomeServerClient, LightRequest, ModeRequest, SetTempRequest,
+                           server_url)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sends a few test requests to the home server")
+    parser.add_argument("--rate", type=float, default=2.0, help="Requests per second")
+    parser.add_argument("--url", default=server_url,
+                        help="Base URL of the home server, ie one from local_stack.FakeHomeServer")
+    args = parser.parse_args()
+
+    # Requests are paced by the queue instead of sleeping after each one
+    commands = CommandQueue(HomeServerClient(url=args.url), rate=args.rate, burst=1, senders=1)
 
     # ----------------------
     # SET TEMPERATURE
     # ----------------------
     print("Attempting to set the temperature")
 
-    # First configure the payload with the desired value
-    server_payload["setTemp"]["setTemp"] = 30
-
-    # Assign the url and payload data
-    url = server_url + server_function["setTemp"]
-    payload = server_payload["setTemp"]
-
-    # Post
-    res = requests.post(url, data=payload, headers=server_header)
+    # Queue the post with the desired value
+    commands.put(SetTempRequest(30))
     print("Done")
-    time.sleep(0.5)
 
     # ----------------------
     # ALL LIGHTS ON
     # ----------------------
     print("Attempting to turn on all lights")
-    server_payload["allLights"]["state"] = "on"
-    url = server_url + server_function["allLights"]
-    payload = server_payload["allLights"]
-    requests.post(url, data=payload, headers=server_header)
+    commands.put(AllLightsRequest("on"))
     print("Done")
-    time.sleep(0.5)
 
     # ----------------------
     # ALL LIGHTS OFF
     # ----------------------
     print("Attempting to turn off all lights")
-    server_payload["allLights"]["state"] = "off"
-    url = server_url + server_function["allLights"]
-    payload = server_payload["allLights"]
-    requests.post(url, data=payload, headers=server_header)
+    commands.put(AllLightsRequest("off"))
     print("Done")
-    time.sleep(0.5)
 
     # ----------------------
     # CHANGE HOUSE MODE
@@ -64,12 +43,8 @@ if __name__ == "__main__":
     # TODO: currently does not trigger the web-page
     # ----------------------
     print("Attempting to turn on the AC")
-    server_payload["mode"]["mode"] = "auto"
-    url = server_url + server_function["mode"]
-    payload = server_payload["mode"]
-    requests.post(url, data=payload, headers=server_header)
+    commands.put(ModeRequest("auto"))
     print("Done")
-    time.sleep(0.5)
 
     # ----------------------
     # CYCLE EACH LIGHT ON/OFF
@@ -77,12 +52,10 @@ if __name__ == "__main__":
     # INCOMPLETE
     # ----------------------
     print("Cycling through all lights")
-    server_payload["light"]["light"] = "Patio Light"
-    server_payload["light"]["state"] = "on"
-
-    url = server_url + server_function["light"]
-    payload = server_payload["light"]
-
-    #requests.post(url, data=payload, headers=server_header)
+    #commands.put(LightRequest("Patio Light", "on"))
     print("Done")
-    time.sleep(0.5)
+
+    # Wait for the queue to drain
+    print("Waiting on " + str(commands.depth) + " queued requests")
+    commands.join()
+    print("Sent " + str(commands.sent) + ", failed " + str(commands.failed))
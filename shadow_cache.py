@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ShadowStateCache:
+    """
+    Per-container read-through cache of thing shadow state. Entries expire
+    after ttl seconds and our own successful writes are merged into the cached
+    desired state, so a follow up directive usually doesn't need a GET.
+    """
+
+    def __init__(self, client, ttl=30.0, clock=time.monotonic, max_workers=8):
+        """
+        :param client: boto3 'iot-data' client, or anything with the same
+            get_thing_shadow(thingName) method
+        :param ttl: Seconds a fetched shadow is trusted for
+        :param clock: Time source, swappable for tests
+        :param max_workers: Most shadow reads in flight at once in get_many()
+        """
+        self.client = client
+        self.ttl = ttl
+        self.clock = clock
+        self.max_workers = max_workers
+        self._entries = {}
+        self._fetch_locks = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get(self, thing_name, max_age=None):
+        """
+        Returns the 'state' section of the thing's shadow, fetching it if the
+        cached copy is missing or stale. Only one caller fetches a given thing
+        at a time; the others wait and reuse its result.
+
+        :param max_age: Seconds of staleness the caller accepts, defaults to ttl
+        """
+        state = self._get_fresh(thing_name, max_age)
+        if state is not None:
+            return state
+
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(thing_name, threading.Lock())
+
+        with fetch_lock:
+            # Somebody else may have fetched it while we waited
+            state = self._get_fresh(thing_name, max_age)
+            if state is not None:
+                return state
+
+            stream_obj = self.client.get_thing_shadow(thingName=thing_name)
+            state = json.loads(stream_obj["payload"].read()).get("state", {})
+            self.put(thing_name, state)
+            return state
+
+    def get_many(self, thing_names, max_age=None):
+        """
+        Like get() for several things, fetching the stale ones in parallel.
+        Things whose shadow can't be read are left out of the result.
+
+        :return: dict of thing name -> state
+        """
+        states = {}
+
+        for thing_name, future in self.prefetch(thing_names, max_age).items():
+            try:
+                states[thing_name] = future.result()
+            except Exception:
+                pass
+
+        for thing_name in thing_names:
+            if thing_name not in states:
+                state = self._get_fresh(thing_name, max_age)
+                if state is not None:
+                    states[thing_name] = state
+
+        return states
+
+    def prefetch(self, thing_names, max_age=None):
+        """
+        Starts fetching the stale ones of thing_names in the background
+        without waiting on them. A get() for one of them meanwhile fetches it
+        straight away, or waits only on that one fetch.
+
+        :return: dict of thing name -> Future of its state
+        """
+        stale = [thing_name for thing_name in thing_names if self._get_fresh(thing_name, max_age) is None]
+        if not stale:
+            return {}
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        return dict((thing_name, self._executor.submit(self.get, thing_name, max_age))
+                    for thing_name in stale)
+
+    def is_fresh(self, thing_name, max_age=None):
+        return self._get_fresh(thing_name, max_age) is not None
+
+    def put(self, thing_name, state):
+        with self._lock:
+            self._entries[thing_name] = (self.clock(), state)
+
+    def update_desired(self, thing_name, desired):
+        """
+        Merges a successfully written desired state into the cached shadow.
+        Things that aren't cached are left alone, since their reported state
+        is still unknown.
+        """
+        with self._lock:
+            entry = self._entries.get(thing_name)
+            if entry is None:
+                return
+
+            fetched_at, state = entry
+            state = dict(state)
+            state["desired"] = dict(state.get("desired", {}), **desired)
+            self._entries[thing_name] = (fetched_at, state)
+
+    def invalidate(self, thing_name):
+        with self._lock:
+            self._entries.pop(thing_name, None)
+
+    def _get_fresh(self, thing_name, max_age=None):
+        entry = self._entries.get(thing_name)
+        if max_age is None:
+            max_age = self.ttl
+
+        if entry is None or self.clock() - entry[0] > max_age:
+            return None
+
+        return entry[1]
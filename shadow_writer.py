@@ -0,0 +1,86 @@
+import json
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Outcome of one update_thing_shadow call. desired is the merged state that was
+# sent, and exactly one of response/error is set.
+ShadowWriteResult = namedtuple('ShadowWriteResult', ['desired', 'response', 'error'])
+
+
+class ShadowWriter:
+    """
+    Collects desired state updates for thing shadows and sends them together.
+    Updates for the same thing are merged so each thing costs one
+    update_thing_shadow call, and different things are written in parallel.
+
+    Updates are queued per thread, so handlers running on several threads
+    each flush only their own.
+    """
+
+    def __init__(self, client, max_workers=8):
+        """
+        :param client: boto3 'iot-data' client, or anything with the same
+            update_thing_shadow(thingName, payload) method
+        :param max_workers: Most shadow writes in flight at once
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def add(self, thing_name, desired):
+        """
+        Queues a desired state update. Keys already queued for the thing are
+        overwritten by the newer values.
+        """
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            pending = self._local.pending = {}
+
+        pending.setdefault(thing_name, {}).update(desired)
+
+    def get_pending(self, thing_name):
+        """
+        :return: Copy of the desired state queued on this thread for the
+            thing and not yet flushed, empty if there is none
+        """
+        pending = getattr(self._local, 'pending', None) or {}
+        return dict(pending.get(thing_name, {}))
+
+    def flush(self):
+        """
+        Sends everything queued since the last flush.
+
+        :return: dict of thing name -> ShadowWriteResult
+        """
+        pending = getattr(self._local, 'pending', None)
+        self._local.pending = None
+
+        if not pending:
+            return {}
+
+        # Not worth a trip through the pool for the usual single directive
+        if len(pending) == 1:
+            thing_name, desired = pending.popitem()
+            return {thing_name: self._write(thing_name, desired)}
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        futures = {thing_name: self._executor.submit(self._write, thing_name, desired)
+                   for thing_name, desired in pending.items()}
+
+        return {thing_name: future.result() for thing_name, future in futures.items()}
+
+    def _write(self, thing_name, desired):
+        try:
+            response = self.client.update_thing_shadow(
+                thingName=thing_name,
+                payload=json.dumps({'state': {'desired': desired}}))
+            return ShadowWriteResult(desired, response, None)
+
+        except Exception as error:
+            return ShadowWriteResult(desired, None, error)
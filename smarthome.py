@@ -1,60 +1,144 @@
 #!/usr/bin/env/python
 
+import argparse
 import os
 import json
+import threading
 import time
-import requests
 
 # This is a dependency not native to the basic RPI install
 # It can be found here: https://pypi.python.org/pypi/AWSIoTPythonSDK/1.0.0
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient
 
-# NAMING CONVENTIONS FOR VARIOUS LIGHTS
-# switch1a - patio light
-# switch1b - hall light
-# switch1c - kitchen light
-# switch1d - dining light
-# switch2a - living room
-# switch2b - bedroom
-# switch2c - restroom
-# switch3a - attic
-
-server_url = 'http://10.194.240.42:3000'
-server_header = {"items": "Content-Type:application/json"}
-server_function = {"light":        "/updateLight",
-                   "allLights":    "/updateAllLight",
-                   "mode":         "/updateMode",
-                   "setTemp":      "/updateSetTemp",
-                   "currentTemp":  "/updateCurrTemp"}
-
-server_payload = {"light":         {"light": "<light_name>",    "state": ""},
-                  "allLights":     {"light": "lights",          "state": ""},
-                  "mode":          {"room": "home",             "mode": ""},
-                  "setTemp":       {"room": "home",             "setTemp": 0},
-                  "currentTemp":   {"room": "home",             "currTemp": 0}}
+from command_queue import CommandQueue, LightCoalescer, TokenBucket
+from delta_dispatch import DeltaDispatcher
+from device_registry import get_registry
+from device_state import StateTable
+from iot_shards import ShardedShadowClient, ShardStats
+from server_client import (HomeServerClient, LightRequest, ModeRequest, SetTempRequest,
+                           server_function, server_header, server_url)
+
+# The devices, and the server switch name of each light, are listed in devices.json
+
+# Last state each device reported to its shadow and sent to the server, so
+# repeats of it can be skipped
+state_table = StateTable()
+
+
+def forget_failed_request(request, key):
+    """
+    Drops the server state a failed request was recorded with, so the next
+    delta asking for it is sent again
+
+    :param key: Name of the device the request was queued for
+    """
+    registry = get_registry()
+
+    if request.function == "allLights":
+        lights = registry.in_category("LIGHT")
+    elif request.function == "light":
+        # Queued under the light coalescer's key, not the device name
+        device = registry.get_by_server_name(request.light)
+        lights = [device] if device is not None else []
+    else:
+        state_table.forget(key, "server")
+        return
+
+    for device in lights:
+        # Unknown rather than forgotten, so get_known_light_state doesn't fall
+        # back to the shadow, which already holds the state that failed
+        state_table.changes(device.appliance_id, "server", {'light': None})
+
+
+# One keep-alive session to the home server shared by every device, fed by a
+# rate limited queue so requests go out as fast as the server can take them
+home_server = HomeServerClient()
+command_queue = CommandQueue(home_server, on_failed=forget_failed_request)
+
+
+def get_known_light_state(server_name):
+    """
+    :return: 'on'/'off' as last sent to the server for the light, or else as
+        last reported to its shadow if it was never sent, None if unknown or
+        the last request for it failed
+    """
+    device = get_registry().get_by_server_name(server_name)
+    if device is None:
+        return None
+
+    server_state = state_table.get(device.appliance_id, "server")
+    if 'light' in server_state:
+        light = server_state['light']
+    else:
+        light = state_table.get(device.appliance_id, "shadow").get('light')
+
+    if light is None:
+        return None
+    return "on" if light else "off"
+
+
+# Turns a burst of identical commands for every light into one allLights
+# request, when --light-window is set
+light_coalescer = LightCoalescer(command_queue,
+                                 [device.server_name for device in get_registry().in_category("LIGHT")],
+                                 known_state=get_known_light_state)
 
 
 class OnOffLightType:
-    def __init__(self, name, friendly_name, iot, server_name):
+    def __init__(self, name, friendly_name, iot, server_name, agent=None):
         """
-        Creates the shadow handler for the object and initializes
-        it to the default state.
+        Creates the shadow handler for the object. Its state is brought in
+        line with the shadow by reconcile_devices().
         :param name: Name of the thing as specified on the IoT dashboard
         :param iot: Object of type returned from createIoT()
+        :param agent: Optional DeltaDispatcher or AsyncAgent that deltas are
+            handed off to. Without one they are handled on the MQTT
+            callback thread.
         """
         self.name = name
         self.server_thing_name = server_name
         self.friendlyName = friendly_name
+        self.agent = agent
         self.shadow = iot.createShadowHandlerWithName(self.name, True)
 
         # Register a function to run when the shadow is updated online
         self.shadow.shadowRegisterDeltaCallback(self.shadowDeltaCallback)
 
-        # Initialize the device to OFF
-        self.set(False)
-
     # CALLBACK FUNCTION
     def shadowDeltaCallback(self, payload, responseStatus, token):
+        if self.agent is not None:
+            self.agent.submit(self, payload)
+            return
+
+        self.handle_delta(payload)
+
+    def handle_delta(self, payload):
+        post_requests(self.apply_delta(payload), self.name)
+
+    def reconcile(self, desired, reported):
+        """
+        Compares the shadow's desired and reported state at startup
+
+        :return: A delta payload for the state still to be applied, or None
+        """
+        if 'light' in desired and desired['light'] != reported.get('light'):
+            return json.dumps({'state': {'light': desired['light']}})
+
+        if 'light' not in reported:
+            # Never reported, initialize the device to OFF
+            self.set(False)
+        else:
+            # Already in sync, only remember what the shadow holds
+            state_table.changes(self.name, "shadow", {'light': reported['light']})
+
+        return None
+
+    def apply_delta(self, payload):
+        """
+        Informs the shadow of the requested state
+
+        :return: The server requests needed to carry it out
+        """
         # Why does this need to be ['state']['light']???
         new_state = json.loads(payload)['state']['light']
 
@@ -66,11 +150,22 @@ class OnOffLightType:
         # Inform the shadow of the new state
         self.set(new_state)
 
-        # Update the Server API
-        self.thing_action(new_state)
+        # Nothing to send if the server already has this state
+        if not state_table.changes(self.name, "server", {'light': new_state}):
+            return []
+
+        return self.server_requests(new_state)
 
     # SHADOW UPDATE ACTION FUNCTION
-    def set(self, state):
+    def set(self, state, force=False):
+        """
+        Reports state to the shadow, unless it was the last state reported
+
+        :param force: Report even if the state hasn't changed
+        """
+        if not state_table.changes(self.name, "shadow", {'light': state}) and not force:
+            return
+
         # Update the shadow handler with the new state
         self.shadow.shadowUpdate(json.dumps({
             'state': {
@@ -79,40 +174,77 @@ class OnOffLightType:
                 }
             }
         }
-        ), None, 5)
+        ), self.shadow_update_callback, 5)
 
         if state:
             print(str(self.friendlyName) + " ON")
         else:
             print(str(self.friendlyName) + " OFF")
 
+    def shadow_update_callback(self, payload, responseStatus, token):
+        # The update didn't land, make sure the next one is sent
+        if responseStatus != "accepted":
+            state_table.forget(self.name, "shadow")
+
     def thing_action(self, state):
+        post_requests(self.server_requests(state), self.name)
+
+    def server_requests(self, state):
+        """
+        :return: List of server_client requests
+        """
         if state:
             temp = "on"
         else:
             temp = "off"
 
-        server_payload["light"]["light"] = self.server_thing_name
-        server_payload["light"]["state"] = temp
-
-        url = server_url + server_function["light"]
-        payload = server_payload["light"]
-
-        requests.post(url, data=payload, headers=server_header)
-        time.sleep(0.5)
+        return [LightRequest(self.server_thing_name, temp)]
 
 
 class ThermostatType:
-    def __init__(self, name, friendly_name, iot, server_name):
+    def __init__(self, name, friendly_name, iot, server_name, agent=None):
         self.name = name
         self.server_thing_name = server_name
         self.friendlyName = friendly_name
+        self.agent = agent
         self.shadow = iot.createShadowHandlerWithName(self.name, True)
 
         # Register a function to run when the shadow is updated online
         self.shadow.shadowRegisterDeltaCallback(self.shadow_delta_callback)
 
     def shadow_delta_callback(self, payload, responseStatus, token):
+        if self.agent is not None:
+            self.agent.submit(self, payload)
+            return
+
+        self.handle_delta(payload)
+
+    def handle_delta(self, payload):
+        post_requests(self.apply_delta(payload), self.name)
+
+    def reconcile(self, desired, reported):
+        """
+        Compares the shadow's desired and reported state at startup
+
+        :return: A delta payload for the state still to be applied, or None
+        """
+        known = dict((key, reported[key]) for key in ('value', 'mode', 'scale') if key in reported)
+        state_table.changes(self.name, "shadow", known)
+
+        corrections = dict((key, desired[key]) for key in ('value', 'mode', 'scale')
+                           if key in desired and desired[key] != reported.get(key))
+
+        if not corrections:
+            return None
+
+        return json.dumps({'state': corrections})
+
+    def apply_delta(self, payload):
+        """
+        Informs the shadow of the requested state
+
+        :return: The server requests needed to carry it out
+        """
         json_data = json.loads(payload)
 
         # Sort through the possible Delta keys we are looking for
@@ -137,24 +269,60 @@ class ThermostatType:
         # Inform the shadow of the new state
         self.update_shadow(new_temp, new_mode, new_scale)
 
-        # Update the Server API
-        self.update_server(new_mode, new_temp)
+        # Only send the server what it doesn't already have
+        server_state = {}
+        if new_mode != "":
+            server_state["mode"] = new_mode
+        if new_temp != "":
+            server_state["setTemp"] = new_temp
+
+        server_state = state_table.changes(self.name, "server", server_state)
 
-    def update_shadow(self, value, mode, scale):
-        update_response = {'state': {'reported': {}}}
+        return self.server_requests(server_state.get("mode", ""), server_state.get("setTemp", ""))
+
+    def update_shadow(self, value, mode, scale, force=False):
+        """
+        Reports the given values to the shadow, leaving out any that match
+        what was last reported
+
+        :param force: Report every given value even if it hasn't changed
+        """
+        reported = {}
 
         if value != "":
-            update_response["state"]["reported"]["value"] = value
+            reported["value"] = value
 
         if mode != "":
-            update_response["state"]["reported"]["mode"] = mode
+            reported["mode"] = mode
 
         if scale != "":
-            update_response["state"]["reported"]["scale"] = scale
+            reported["scale"] = scale
+
+        changed = state_table.changes(self.name, "shadow", reported)
+        if force:
+            changed = reported
 
-        self.shadow.shadowUpdate(json.dumps(update_response), None, 5)
+        if not changed:
+            return
+
+        update_response = {'state': {'reported': changed}}
+
+        self.shadow.shadowUpdate(json.dumps(update_response), self.shadow_update_callback, 5)
+
+    def shadow_update_callback(self, payload, responseStatus, token):
+        # The update didn't land, make sure the next one is sent
+        if responseStatus != "accepted":
+            state_table.forget(self.name, "shadow")
 
     def update_server(self, mode, temp):
+        post_requests(self.server_requests(mode, temp), self.name)
+
+    def server_requests(self, mode, temp):
+        """
+        :return: List of server_client requests
+        """
+        requests_to_send = []
+
         # New AC Mode Update
         if mode != "":
             if mode == "COOL":
@@ -166,65 +334,229 @@ class ThermostatType:
             else:
                 new_mode = "mode1"
 
-            server_payload["mode"]["mode"] = new_mode
-
-            url = server_url + server_function["mode"]
-            payload = server_payload["mode"]
-
-            requests.post(url, data=payload, headers=server_header)
-            time.sleep(0.5)
+            requests_to_send.append(ModeRequest(new_mode))
 
         # New Temperature Update
         if temp != "":
-            server_payload["setTemp"]["setTemp"] = temp
+            requests_to_send.append(SetTempRequest(temp))
 
-            url = server_url + server_function["setTemp"]
-            payload = server_payload["setTemp"]
+        return requests_to_send
 
-            requests.post(url, data=payload, headers=server_header)
-            time.sleep(0.5)
 
+def post_requests(requests_to_send, key=None):
+    """
+    Queues server_client requests for the server. Requests with the same key
+    are sent in order.
+    """
+    for request in requests_to_send:
+        light_coalescer.put(request, key)
 
-def create_iot(endpoint='', credentials='rootCA.pem'):
+
+def create_iot(endpoint='', credentials='rootCA.pem', client_id='AlexaPi', on_online=None, on_offline=None):
     """
     Creates a connection to a Thing in the user's IoT dashboard.
 
     :param endpoint: HTTPS link to the thing. Can be found under the
         "Interact" tab of the Thing in the developer dashboard.
     :param credentials: filename for the credentials of this thing
+    :param client_id: MQTT client id, must be unique per connection
+    :param on_online: Called when the connection comes up
+    :param on_offline: Called when the connection drops
     :return: iot object
     """
     # Can the 'AlexaPi' be arbitrary?
-    iot_thing = AWSIoTMQTTShadowClient('AlexaPi', useWebsocket=True)
+    iot_thing = AWSIoTMQTTShadowClient(client_id, useWebsocket=True)
 
     iot_thing.configureEndpoint(endpoint, 443)
     iot_thing.configureCredentials(os.path.join(os.path.dirname(os.path.realpath(__file__)), credentials))
     iot_thing.configureConnectDisconnectTimeout(10)
     iot_thing.configureMQTTOperationTimeout(5)
+
+    # connect() binds these, so they have to be set before it
+    if on_online is not None:
+        iot_thing.onOnline = on_online
+    if on_offline is not None:
+        iot_thing.onOffline = on_offline
+
     iot_thing.connect()
     return iot_thing
 
 
+def connect_iot(endpoint, shards=1):
+    """
+    Connects to AWS IoT over one MQTT connection, or over several with the
+    devices spread between them by floor
+
+    :return: iot object, a ShardedShadowClient when shards > 1
+    """
+    if shards <= 1:
+        return create_iot(endpoint=endpoint)
+
+    stats = [ShardStats() for _ in range(shards)]
+    clients = [create_iot(endpoint=endpoint, client_id='AlexaPi-' + str(shard),
+                          on_online=stats[shard].on_online, on_offline=stats[shard].on_offline)
+               for shard in range(shards)]
+
+    return ShardedShadowClient(clients, stats,
+                               thing_names=[device.appliance_id for device in get_registry().devices])
+
+
+def reconcile_devices(devices, timeout=10):
+    """
+    Brings every device in line with its shadow at startup. All of the
+    shadows are requested at once, so startup takes about one round trip
+    however many devices there are, and never more than timeout seconds.
+    Devices whose desired state differs from their reported state get that
+    difference applied like a normal delta. Devices whose shadow didn't
+    answer in time are left alone.
+
+    :param devices: dict of thing name -> device object
+    :return: Number of devices that needed a correction
+    """
+    results = {}
+    lock = threading.Lock()
+    all_answered = threading.Event()
+
+    def get_callback(thing_name):
+        def callback(payload, responseStatus, token):
+            with lock:
+                results[thing_name] = (payload, responseStatus)
+                if len(results) == len(devices):
+                    all_answered.set()
+        return callback
+
+    for thing_name, device in devices.items():
+        device.shadow.shadowGet(get_callback(thing_name), timeout)
+
+    if devices and not all_answered.wait(timeout):
+        print("Timed out waiting on " + str(len(devices) - len(results)) + " shadows")
+
+    corrected = 0
+
+    for thing_name, device in devices.items():
+        with lock:
+            payload, status = results.get(thing_name, (None, "timeout"))
+
+        if status == "timeout":
+            # Unknown isn't the same as empty, reporting a default state here
+            # would overwrite the real one. The next delta syncs the device.
+            print("No shadow answer for " + thing_name + ", leaving it as it is")
+            continue
+
+        if status == "accepted":
+            state = json.loads(payload).get('state', {})
+        else:
+            # No shadow yet, treat it as empty
+            state = {}
+
+        delta = device.reconcile(state.get('desired', {}), state.get('reported', {}))
+        if delta is None:
+            continue
+
+        corrected += 1
+        if device.agent is not None:
+            device.agent.submit(device, delta)
+        else:
+            device.handle_delta(delta)
+
+    return corrected
+
+
+def create_devices(registry, iot, agent=None):
+    """
+    Creates a device object for every entry in the registry
+
+    :return: dict of thing name -> device object
+    """
+    device_types = {"THERMOSTAT": ThermostatType, "LIGHT": OnOffLightType}
+    devices = {}
+
+    for device in registry.devices:
+        device_type = device_types.get(device.category)
+        if device_type is None:
+            print("Skipping " + device.appliance_id + ", unknown category " + device.category)
+            continue
+
+        devices[device.appliance_id] = device_type(device.appliance_id, device.friendly_name, iot,
+                                                   device.server_name, agent)
+
+    return devices
+
+
+def run_asyncio_agent(endpoint, shards, rate_limiter):
+    """
+    Runs the devices with deltas handled by an AsyncAgent event loop
+    """
+    import asyncio
+    from async_agent import AsyncAgent
+
+    agent = AsyncAgent(server_url, server_function, server_header, rate_limiter=rate_limiter,
+                       on_failed=forget_failed_request)
+
+    def setup():
+        print("Connecting all the things...")
+        iot = connect_iot(endpoint, shards)
+        print("Done!")
+
+        print("Initializing all devices...")
+        devices = create_devices(get_registry(), iot, agent)
+        print("Done! " + str(reconcile_devices(devices)) + " devices needed a correction")
+        print('Listening...')
+
+    asyncio.run(agent.run(setup))
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AlexaPi device agent")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="Handle shadow deltas on an asyncio event loop (needs aiohttp)")
+    parser.add_argument("--server-rate", type=float, default=5.0,
+                        help="Requests per second the home server can take")
+    parser.add_argument("--server-burst", type=int, default=5,
+                        help="Requests that may be sent back to back")
+    parser.add_argument("--light-window", type=float, default=0,
+                        help="Seconds light commands are held to be merged into one allLights request. "
+                             "Every light command is delayed by up to this long. 0 (default) disables")
+    parser.add_argument("--always-publish", action="store_true",
+                        help="Report and send every update, even ones that match the last known state")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="MQTT connections to spread the devices over, split by floor")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Threads handling shadow deltas")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="Seconds between per device timing reports, 0 disables")
+    args = parser.parse_args()
+
+    command_queue.limiter = TokenBucket(args.server_rate, args.server_burst)
+    light_coalescer.window = args.light_window
+    state_table.enabled = not args.always_publish
+
     # In this case the endpoint for ALL the devices are the same. Perhaps
     # it is because they share a common security profile? Not too sure why.
-    print("Connecting all the things...")
-    iot_ap = create_iot(endpoint='atnox9aalr8w3.iot.us-east-1.amazonaws.com')
-    print("Done!")
-
-    print("Initializing all devices...")
-    ThermostatType('Thermostat', 'Thermostat', iot_ap, 'n/a')
-    OnOffLightType('F1_DiningLight', 'Dining Room Light', iot_ap, "switch1d")
-    OnOffLightType('F1_KitchenLight', 'Kitchen Light', iot_ap, "switch1c")
-    OnOffLightType('F1_HallLight', 'Hall Light', iot_ap, "switch1b")
-    OnOffLightType('F1_PatioLight', 'Patio Light', iot_ap, "switch1a")
-    OnOffLightType('F2_RestRoomLight', 'Rest Room Light', iot_ap, "switch2c")
-    OnOffLightType('F2_BedRoomLight', 'Bed Room Light', iot_ap, "switch2b")
-    OnOffLightType('F2_LivingRoomLight', 'Living Room Light', iot_ap, "switch2a")
-    OnOffLightType('F3_AtticLight', 'Attic Light', iot_ap, "switch3a")
-    print("Done!")
-    time.sleep(1)
-    print('Listening...')
-
-    while True:
-        time.sleep(0.2)
+    iot_endpoint = 'atnox9aalr8w3.iot.us-east-1.amazonaws.com'
+
+    if args.asyncio:
+        run_asyncio_agent(iot_endpoint, args.shards, command_queue.limiter)
+    else:
+        print("Connecting all the things...")
+        iot_ap = connect_iot(iot_endpoint, args.shards)
+        print("Done!")
+
+        print("Initializing all devices...")
+        dispatcher = DeltaDispatcher(args.workers)
+        devices = create_devices(get_registry(), iot_ap, dispatcher)
+        print("Done! " + str(reconcile_devices(devices)) + " devices needed a correction")
+        time.sleep(1)
+        print('Listening...')
+
+        while True:
+            if args.stats_interval > 0:
+                time.sleep(args.stats_interval)
+                report = {"queued_deltas": dispatcher.depth,
+                          "queued_commands": command_queue.depth,
+                          "devices": dispatcher.report()}
+                if isinstance(iot_ap, ShardedShadowClient):
+                    report["shards"] = iot_ap.report()
+                print(json.dumps(report, sort_keys=True))
+            else:
+                time.sleep(0.2)
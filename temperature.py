@@ -0,0 +1,102 @@
+"""
+Thermostat setpoint arithmetic across the scales Alexa uses. Values are
+normalized to Celsius, deltas are applied and clamped there, and the result
+is converted to the scale wanted.
+"""
+
+CELSIUS = "CELSIUS"
+FAHRENHEIT = "FAHRENHEIT"
+KELVIN = "KELVIN"
+
+# celsius = value * factor + offset
+SCALES = {
+    CELSIUS: (1.0, 0.0),
+    FAHRENHEIT: (5.0 / 9.0, -160.0 / 9.0),
+    KELVIN: (1.0, -273.15)
+}
+
+# Setpoints the thermostat accepts. Adjustments are clamped to this range,
+# setting a value outside of it is refused.
+SETPOINT_MIN_CELSIUS = 10.0
+SETPOINT_MAX_CELSIUS = 32.0
+
+
+class SetpointOutOfRange(ValueError):
+    """
+    Raised by set_setpoint for a value outside of [minimum, maximum]
+    """
+
+    def __init__(self, value, scale, minimum, maximum):
+        """
+        :param minimum: Lowest accepted setpoint, in scale
+        :param maximum: Highest accepted setpoint, in scale
+        """
+        super(SetpointOutOfRange, self).__init__(
+            str(value) + " " + scale + " is outside of " + str(minimum) + " - " + str(maximum))
+        self.scale = scale
+        self.minimum = minimum
+        self.maximum = maximum
+
+
+def get_scale(scale):
+    try:
+        return SCALES[scale]
+    except KeyError:
+        raise ValueError("Unknown temperature scale " + repr(scale))
+
+
+def to_celsius(value, scale):
+    factor, offset = get_scale(scale)
+    return value * factor + offset
+
+
+def from_celsius(value, scale):
+    factor, offset = get_scale(scale)
+    return (value - offset) / factor
+
+
+def convert(value, from_scale, to_scale):
+    if from_scale == to_scale:
+        return value
+    return from_celsius(to_celsius(value, from_scale), to_scale)
+
+
+def delta_to_celsius(delta, scale):
+    # A difference has no offset, 1 degree F is 5/9 degree C wherever it starts
+    return delta * get_scale(scale)[0]
+
+
+def clamp(value, minimum=SETPOINT_MIN_CELSIUS, maximum=SETPOINT_MAX_CELSIUS):
+    return min(max(value, minimum), maximum)
+
+
+def set_setpoint(value, scale, to_scale, minimum=SETPOINT_MIN_CELSIUS, maximum=SETPOINT_MAX_CELSIUS):
+    """
+    Converts a requested setpoint to to_scale, rounded to a tenth of a degree
+
+    :raises SetpointOutOfRange: The value is outside of [minimum, maximum]
+        Celsius
+    """
+    # Rounded so a limit given in another scale, ie 50 F, isn't refused for float error
+    celsius = round(to_celsius(value, scale), 6)
+
+    if not minimum <= celsius <= maximum:
+        raise SetpointOutOfRange(value, scale, round(from_celsius(minimum, scale), 1),
+                                 round(from_celsius(maximum, scale), 1))
+
+    return round(from_celsius(celsius, to_scale), 1)
+
+
+def adjust_setpoint(current, current_scale, delta, delta_scale, to_scale,
+                    minimum=SETPOINT_MIN_CELSIUS, maximum=SETPOINT_MAX_CELSIUS):
+    """
+    Applies a delta to a setpoint when the two may be in different scales
+
+    :param current: Current setpoint, in current_scale
+    :param delta: Change requested, in delta_scale
+    :param to_scale: Scale of the returned setpoint
+    :return: New setpoint in to_scale, clamped to [minimum, maximum] Celsius
+        and rounded to a tenth of a degree
+    """
+    celsius = to_celsius(current, current_scale) + delta_to_celsius(delta, delta_scale)
+    return round(from_celsius(clamp(celsius, minimum, maximum), to_scale), 1)
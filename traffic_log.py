@@ -0,0 +1,168 @@
+import atexit
+import gzip
+import json
+import os
+import threading
+import time
+
+# Scope and access tokens are replaced by this in recorded directives
+REDACTED = "REDACTED"
+REDACTED_KEYS = frozenset(("token", "accessToken"))
+
+
+def redact(payload):
+    """
+    Copies a directive or response with every token value replaced
+    """
+    if isinstance(payload, dict):
+        return dict((key, REDACTED if key in REDACTED_KEYS else redact(value))
+                    for key, value in payload.items())
+
+    if isinstance(payload, list):
+        return [redact(value) for value in payload]
+
+    return payload
+
+
+class TrafficRecorder:
+    """
+    Appends directives and their responses to a JSONL file, one
+    {"timestamp", "request", "response"} object per line with tokens redacted.
+    Lines are buffered, and once the file passes max_bytes it is rotated to
+    path.1, path.2, ... keeping the newest backups.
+
+    On Lambda call flush() before each invocation returns, a frozen
+    container can be reaped without running atexit.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backups=5, buffer_size=64 * 1024):
+        """
+        :param path: File to append to
+        :param max_bytes: Size at which the file is rotated
+        :param backups: Rotated files kept, the oldest is deleted
+        :param buffer_size: Bytes buffered before they are written out
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._size = 0
+        self._file = self._open()
+
+        # Covers a clean exit only, see flush()
+        atexit.register(self.close)
+
+    def record(self, request, response, timestamp=None):
+        line = json.dumps({"timestamp": time.time() if timestamp is None else timestamp,
+                           "request": redact(request),
+                           "response": redact(response)},
+                          separators=(',', ':')) + "\n"
+
+        with self._lock:
+            if self._file is None:
+                return
+
+            self._file.write(line)
+
+            # json.dumps escapes non-ASCII, so characters are bytes
+            self._size += len(line)
+            if self._size >= self.max_bytes:
+                self._rotate()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _open(self):
+        self._size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return open(self.path, "a", buffering=self.buffer_size)
+
+    def _rotate(self):
+        self._file.close()
+
+        for index in range(self.backups - 1, 0, -1):
+            older = self.path + "." + str(index)
+            if os.path.exists(older):
+                os.replace(older, self.path + "." + str(index + 1))
+
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+        self._file = self._open()
+
+
+def get_rotated_paths(path):
+    """
+    :return: path and its rotated backups, oldest first
+    """
+    backups = []
+    index = 1
+    while os.path.exists(path + "." + str(index)):
+        backups.append(path + "." + str(index))
+        index += 1
+
+    return list(reversed(backups)) + ([path] if os.path.exists(path) else [])
+
+
+def read_records(paths):
+    """
+    Lazily yields the JSON objects in one or more JSONL files, gzipped or not,
+    a line at a time so captures of any size can be replayed
+
+    :param paths: A path or a list of paths, read in order
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+
+        with opener(path, "rt") as records:
+            for line in records:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def read_requests(paths):
+    """
+    Lazily yields the V3 directives in recorded files, or in files holding
+    one bare {"directive": ...} request per line
+    """
+    for record in read_records(paths):
+        request = record.get("request", record)
+        if "directive" in request:
+            yield request
+
+
+def paced(records, speed=1.0, clock=time.monotonic, sleep=time.sleep):
+    """
+    Yields recorded lines at the rate they were recorded, speed times faster,
+    so bursts in the capture are replayed as bursts. Lines without a
+    timestamp are yielded straight away.
+    """
+    first_recorded = None
+    started = clock()
+
+    for record in records:
+        timestamp = record.get("timestamp")
+
+        if timestamp is not None:
+            if first_recorded is None:
+                first_recorded = timestamp
+
+            wait = (timestamp - first_recorded) / speed - (clock() - started)
+            if wait > 0:
+                sleep(wait)
+
+        yield record